@@ -0,0 +1,563 @@
+"""
+Benchmarks of the perf-sheet and restricted-list stages on synthetic eVestment-shaped data.
+
+Synthetic input workbooks are generated for each size (number of holdings rows): the holdings export with
+its country header rows and 'US Dollar Spot' cash row, the characteristics workbook with its formatted
+template, 'Characteristics' and 'Sectors' sheets, the market-cap holdings workbook, the strategy performance
+blocks, the allocations file and the restricted-list sources used by generate-excel. Each stage is then
+timed and its peak memory measured, and the results are compared against a stored baseline.
+
+Usage:
+    python benchmark.py                                  # 1k and 10k rows, compared to the baseline if there is one
+    python benchmark.py --sizes 1000 10000 100000 1000000
+    python benchmark.py --save-baseline                  # record the results as the new baseline
+    python benchmark.py --sizes --stages start_cli start_perf_sheet   # only the cold start of the command line
+
+The cold start stages time the command line (cli.py) in a fresh interpreter: parsing its arguments, and
+importing each script with the dependencies its commands load.
+
+The baseline (benchmark-baseline.json next to this file) holds the seconds and peak MB of each stage and size.
+Timings only compare on the same machine, so it isn't kept in git: record one with --save-baseline on the
+machine the benchmark runs on (e.g. from the commit before a change), then run without it to compare.
+--save-baseline only replaces the stages and sizes that were run, so a baseline can be built up in parts.
+
+The exit status is 1 if any stage is slower or uses more memory than the baseline allows.
+"""
+
+# For DataFrames
+import numpy as np
+import pandas as pd
+
+# For Excel Editing
+from openpyxl import Workbook, load_workbook
+from openpyxl.styles import Font, Alignment, PatternFill
+
+# For running the benchmarks
+import argparse
+import contextlib
+import importlib.machinery
+import importlib.util
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+# For skipping the Excel parsing of generated files that haven't changed
+from excel_cache import read_excel_cached
+
+# For turning off the metrics files of the scripts being benchmarked
+import metrics
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Bumped whenever the generated files change shape, so old ones are regenerated
+GENERATOR_VERSION = 2
+
+DEFAULT_SIZES = [1000, 10000]
+
+# Commands timed from a fresh interpreter by the cold start stages, run from this directory
+COLD_START = {
+    'start_cli': ['cli.py', 'perf-sheet', '--help'],
+    'start_restricted_list': ['-c', 'import cli; cli.load_script("restricted_list")'],
+    'start_perf_sheet': ['-c', 'import cli; cli.load_script("perf_sheet")'],
+}
+DEFAULT_DATA_DIR = os.path.join(HERE, '.benchmark-data')
+DEFAULT_BASELINE = os.path.join(HERE, 'benchmark-baseline.json')
+
+# A stage regresses when it is this many times slower (or larger) than the baseline, and by more than the noise floor
+DEFAULT_TOLERANCE = 1.25
+NOISE_SECONDS = 0.05
+NOISE_MB = 1.0
+
+# Label of the row with the overall characteristics, as looked up by create_chars_excel
+OVERALL_LABEL = '##############################'
+
+COUNTRIES = ['Japan', 'United Kingdom', 'France', 'Germany', 'Switzerland', 'Sweden', 'Italy', 'Spain',
+             'Netherlands', 'Denmark', 'Norway', 'Finland', 'Belgium', 'Austria', 'Ireland', 'Portugal',
+             'Australia', 'New Zealand', 'Hong Kong', 'Singapore', 'Korea', 'Taiwan', 'India', 'China',
+             'Brazil', 'Mexico', 'South Africa', 'Indonesia', 'Thailand', 'Malaysia']
+SECTORS = ['Communication Services', 'Consumer Discretionary', 'Consumer Staples', 'Energy', 'Financials',
+           'Health Care', 'Industrials', 'Information Technology', 'Materials', 'Real Estate', 'Utilities']
+MARKET_CAPS = ['7.5-15B', '1.5-7.5B', '750M-1.5B', '400-750M', '<400M']
+STRATEGIES = ["EAFE Small Cap Value", "EM Small Cap Value", "Int'l Small Cap Value", "ISC Impact"]
+REGIONS = ['North America', 'United Kingdom', 'Euroland (EU) Countries', 'Non-Euroland (EU) Countries',
+           'Far East & Australasia', 'Other', 'Latin America', 'Africa/Middle East', 'Eastern Europe',
+           'Far East ex-China', 'China', 'Other Emerging Markets', 'Emerging Market Total']
+
+
+def load_script(name, file_name):
+    """
+    Imports one of the notebook scripts as a module, without running its notebook cells.
+
+    Args:
+        name (str): The name to give the module.
+        file_name (str): The script's file name, relative to this file.
+
+    Returns:
+        module (module): The imported script.
+    """
+    if HERE not in sys.path:
+        sys.path.insert(0, HERE)
+    loader = importlib.machinery.SourceFileLoader(name, os.path.join(HERE, file_name))
+    spec = importlib.util.spec_from_loader(name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+# Synthetic data
+
+def make_holdings(n, seed=0):
+    """
+    Makes a holdings export with n rows, shaped like the eVestment file read with skiprows=10.
+
+    Securities are grouped under country header rows (country in 'Unnamed: 1'), followed by a
+    'Not Classified' header and the 'US Dollar Spot' cash row, whose 'ISIN' is empty.
+
+    Args:
+        n (int): The number of rows.
+        seed (int): The random seed.
+
+    Returns:
+        holds (pandas.DataFrame): The holdings, with the export's column names.
+    """
+    rng = np.random.default_rng(seed)
+    n_countries = min(len(COUNTRIES), max(1, n // 25))
+    n_secs = max(n_countries, n - n_countries - 2)
+    cash = 2.5
+
+    sec_country = np.sort(rng.integers(0, n_countries, n_secs))
+    sec_weight = rng.random(n_secs)
+    sec_weight *= (100 - cash) / sec_weight.sum()
+    price = rng.uniform(1, 200, n_secs).round(2)
+    shares = rng.integers(100, 100000, n_secs).astype(float)
+
+    # Country header row followed by its securities, for every country
+    starts = np.searchsorted(sec_country, np.arange(n_countries))
+    is_header = np.zeros(n_secs + n_countries, dtype=bool)
+    is_header[starts + np.arange(n_countries)] = True
+    rows = len(is_header)
+
+    unnamed_1 = np.full(rows, None, dtype=object)
+    unnamed_2 = np.full(rows, None, dtype=object)
+    isin = np.full(rows, None, dtype=object)
+    ticker = np.full(rows, None, dtype=object)
+    pos = np.full(rows, np.nan)
+    px = np.full(rows, np.nan)
+    wgt = np.full(rows, np.nan)
+    mkt = np.full(rows, np.nan)
+    cap = np.full(rows, np.nan)
+
+    ids = np.arange(n_secs)
+    sec_rows = np.flatnonzero(~is_header)
+    unnamed_1[is_header] = [COUNTRIES[c] for c in range(n_countries)]
+    wgt[is_header] = np.bincount(sec_country, weights=sec_weight, minlength=n_countries)
+    unnamed_2[sec_rows] = [f'Security {i} Ltd' for i in ids]
+    isin[sec_rows] = [f'XS{i:010d}' for i in ids]
+    ticker[sec_rows] = [f'T{i}' for i in ids]
+    pos[sec_rows] = shares
+    px[sec_rows] = price
+    wgt[sec_rows] = sec_weight
+    mkt[sec_rows] = shares * price
+    cap[sec_rows] = rng.lognormal(21, 1.5, n_secs).round(-3)
+
+    holds = pd.DataFrame({'Unnamed: 0': None, 'Unnamed: 1': unnamed_1, 'Unnamed: 2': unnamed_2, 'ISIN': isin,
+                          'Ticker': ticker, 'Pos': pos, 'Px Close': px, '% Wgt': wgt, 'Mkt Val': mkt,
+                          'Mkt Cap': cap})
+    tail = pd.DataFrame({'Unnamed: 0': [None, None], 'Unnamed: 1': ['Not Classified', None],
+                         'Unnamed: 2': [None, 'US Dollar Spot'], 'ISIN': [None, None], 'Ticker': [None, None],
+                         'Pos': [np.nan, 1e6], 'Px Close': [np.nan, 1.0], '% Wgt': [cash, cash], 'Mkt Val': [np.nan, 1e6],
+                         'Mkt Cap': [np.nan, np.nan]})
+    return pd.concat([holds, tail], ignore_index=True)
+
+
+def make_restricted_sources(n, seed=0):
+    """
+    Makes the restricted-list sources read by generate-excel, n securities in total.
+
+    Args:
+        n (int): The number of securities across the sources.
+        seed (int): The random seed.
+
+    Returns:
+        ab (pandas.DataFrame): The first list, with 'Security ID', 'Bloomberg ID', 'ISIN', 'SEDOL1' and 'Security Name'.
+        cd (pandas.DataFrame): The second list, with the same columns.
+        wl (pandas.DataFrame): The watchlist, with 'BB TICKER', 'ISIN', 'SEDOL' and 'NAME'.
+    """
+    rng = np.random.default_rng(seed)
+    ids = rng.permutation(n * 2)[:n]
+    split = [int(n * 0.4), int(n * 0.8)]
+
+    def listing(part):
+        return pd.DataFrame({'Security ID': [f'S{i}' for i in part], 'Bloomberg ID': [f'B{i} EQUITY' for i in part],
+                             'ISIN': [f'XS{i:010d}' for i in part], 'SEDOL1': [f'{i:07d}' for i in part],
+                             'Security Name': [f'Security {i} Ltd' for i in part], 'Exchange': 'XLON'})
+
+    ab = listing(ids[:split[0]])
+    cd = listing(ids[split[0]:split[1]])
+    part = ids[split[1]:]
+    wl = pd.DataFrame({'BB TICKER': [f'W{i} Equity' for i in part], 'ISIN': [f'XS{i:010d}' for i in part],
+                       'SEDOL': [f'{i:07d}' for i in part], 'NAME': [f'Security {i} Ltd' for i in part],
+                       'Added By': 'Compliance'})
+    return ab, cd, wl
+
+
+def make_master_lists(n, seed=0):
+    """
+    Makes yesterday's and today's restricted master lists from the synthetic sources, about 2% of the
+    securities being added and 2% dropped between them.
+
+    Args:
+        n (int): The number of securities on each list.
+        seed (int): The random seed.
+
+    Returns:
+        today_df (pandas.DataFrame): Today's master list.
+        yest_df (pandas.DataFrame): Yesterday's master list.
+    """
+    ab, cd, wl = make_restricted_sources(int(n * 1.02) + 1, seed)
+    abcd = pd.concat([ab, cd]).rename(columns={'Bloomberg ID': 'Symbol', 'SEDOL1': 'SEDOL', 'Security Name': 'CompanyName'})
+    wl = wl.rename(columns={'BB TICKER': 'Symbol', 'NAME': 'CompanyName'})
+    full = pd.concat([abcd, wl], ignore_index=True)[['Symbol', 'ISIN', 'SEDOL', 'CompanyName']]
+    full['StartDate'] = '01/02/2024'
+    full['ListName'] = 'Restricted List'
+
+    changed = max(1, n // 50)
+    today_df = full.iloc[changed:changed + n].reset_index(drop=True)
+    yest_df = full.iloc[:n].reset_index(drop=True)
+    return today_df, yest_df
+
+
+def write_rows(path, sheets):
+    """
+    Writes sheets of rows to a new workbook in write-only mode, so large files are written in constant memory.
+
+    Args:
+        path (str): The path of the workbook.
+        sheets (dict): A dictionary where keys are sheet names and values are iterables of rows.
+
+    Returns:
+        None
+    """
+    wb = Workbook(write_only=True)
+    for name, rows in sheets.items():
+        ws = wb.create_sheet(name)
+        for row in rows:
+            ws.append(row)
+    wb.save(path)
+
+
+def frame_rows(df, skiprows=0, header=True):
+    """
+    Yields the rows of a DataFrame as they would be laid out in an Excel export.
+
+    Args:
+        df (pandas.DataFrame): The DataFrame.
+        skiprows (int): The number of filler rows above the header.
+        header (bool): Whether to write the header row. 'Unnamed' columns get an empty header cell.
+
+    Returns:
+        rows (generator): The rows, as lists of values.
+    """
+    for i in range(skiprows):
+        yield [f'Report line {i + 1}']
+    if header:
+        yield [None if str(c).startswith('Unnamed') else c for c in df.columns]
+    for row in df.itertuples(index=False):
+        yield [None if isinstance(v, float) and np.isnan(v) else v for v in row]
+
+
+def characteristics_rows(holds):
+    """
+    Yields the rows of the 'Characteristics' sheet for a holdings export: the overall row at row 9, then
+    country rows (country in 'B', weight in 'D') and security rows (name in 'C', weight in 'D') from row 14.
+
+    Args:
+        holds (pandas.DataFrame): The holdings export, see make_holdings.
+
+    Returns:
+        rows (generator): The rows, as lists of values.
+    """
+    for i in range(8):
+        yield [f'Characteristics header {i + 1}']
+    overall = [OVERALL_LABEL] + [None] * 28
+    for i, col in enumerate(range(6, 29, 2)):  # Columns G, I, ..., AC
+        overall[col] = 1.0 + i
+    yield overall
+    for i in range(4):
+        yield [None]
+    for row in holds.itertuples(index=False):
+        weight = None if np.isnan(row[7]) else row[7]
+        yield [None, row[1], row[2], weight]
+
+
+def template_rows():
+    """
+    Yields the rows of the formatted 'CharacteristicsUpdated' template.
+
+    Returns:
+        rows (generator): The rows, as lists of values.
+    """
+    for r in range(1, 90):
+        yield [f'Characteristic {r}', None, None, None, None, f'Note {r}']
+
+
+def generate(size, data_dir):
+    """
+    Generates the synthetic input files for one size, unless they already exist.
+
+    Args:
+        size (int): The number of holdings rows.
+        data_dir (str): The directory the files are written to.
+
+    Returns:
+        files (dict): A dictionary where keys are the kind of file ('holdings', 'characteristics', 'market_caps',
+        'performance', 'allocations', 'ab', 'cd', 'watchlist') and values are their paths.
+    """
+    prefix = os.path.join(data_dir, f'v{GENERATOR_VERSION}-{size}-')
+    files = {kind: f'{prefix}{kind}.xlsx' for kind in ['holdings', 'characteristics', 'market_caps', 'performance',
+                                                        'allocations', 'ab', 'cd', 'watchlist']}
+    if all(os.path.exists(path) for path in files.values()):
+        return files
+
+    os.makedirs(data_dir, exist_ok=True)
+    holds = make_holdings(size)
+    write_rows(files['holdings'], {'Holdings': frame_rows(holds, skiprows=10)})
+
+    # The template is styled and merged like the real one, so copying it is representative
+    write_rows(files['characteristics'], {'Characteristics': characteristics_rows(holds),
+                                          'Sectors': [[None, s, None, None, 5.0 + i] for i, s in enumerate(SECTORS)]})
+    wb = load_workbook(files['characteristics'])
+    template = wb.create_sheet('CharacteristicsUpdated', 0)
+    for row in template_rows():
+        template.append(row)
+    for r in range(1, 90):
+        template[f'A{r}'].font = Font(name='Tahoma', size=10, bold=(r % 5 == 0))
+        template[f'B{r}'].number_format = '0.00%'
+        template[f'B{r}'].alignment = Alignment(horizontal='center')
+        if r % 10 == 0:
+            template[f'A{r}'].fill = PatternFill(start_color='D3D3D3', end_color='D3D3D3', fill_type='solid')
+    for merged in ['F12:H12', 'F13:G13', 'B14:E14', 'B63:C63', 'B77:C77']:
+        template.merge_cells(merged)
+    wb.save(files['characteristics'])
+
+    caps = [[None, bucket, None, 19.5] for bucket in MARKET_CAPS]
+    write_rows(files['market_caps'], {'Holdings': caps + [[None, row[2], row[3], row[7]]
+                                                          for row in holds.itertuples(index=False)]})
+
+    perf_rows = [[None, None, None, None, 'Report']]
+    for strategy in STRATEGIES:
+        perf_rows += [[None, strategy], [None, 'Period'], [None, 'MTD', 0.012, 0.011]]
+    write_rows(files['performance'], {'Performance': perf_rows})
+
+    markets = REGIONS[:1] + [c for c in COUNTRIES] + REGIONS[1:]
+    write_rows(files['allocations'], {'Allocations': [['Market', 'Country', 'Currency']] +
+                                                     [[m, 1.0, 1.0] for m in markets]})
+
+    ab, cd, wl = make_restricted_sources(size)
+    write_rows(files['ab'], {'Sheet1': frame_rows(ab, skiprows=3)})
+    write_rows(files['cd'], {'Sheet1': frame_rows(cd, skiprows=3)})
+    write_rows(files['watchlist'], {'Sheet1': frame_rows(wl, skiprows=3)})
+    return files
+
+
+# Stages
+
+def stages(perf, restricted):
+    """
+    Lists the benchmarked stages. Each has a setup function, whose result is not measured, and a run function
+    taking the setup's result.
+
+    Args:
+        perf (module): The evest-to-perf-sheet script.
+        restricted (module): The generate-excel script.
+
+    Returns:
+        stages (dict): A dictionary where keys are stage names and values are (setup, run) pairs. Setup functions
+        take the generated files and the size.
+    """
+    holdings_columns = ['Identifier', 'Identifier Type', 'Ticker', 'Security Name', 'Security Type',
+                        '# of Shares', 'Security Price', 'Weight (%)', 'Country', 'Market Value']
+
+    def read_holds(files, size):
+        return read_excel_cached(files['holdings'], skiprows=10)
+
+    def setup_alloc(files, size):
+        holds = read_holds(files, size)
+        alloc = read_excel_cached(files['allocations'])
+        alloc.columns = ['Market', 'Country (%)', 'Currency (%)']
+        return perf.get_countries_weighted(holds), alloc
+
+    def setup_chars(files, size):
+        return load_workbook(files['characteristics']), perf.get_market_cap_weights(read_holds(files, size))
+
+    def setup_copy(files, size):
+        wb, caps = setup_chars(files, size)
+        return perf.create_chars_excel(wb, caps), Workbook().active
+
+    def setup_export(files, size):
+        today_df, _ = make_master_lists(size)
+        constants = restricted.master_list_constants()
+        path = os.path.join(os.path.dirname(files['holdings']), f'{size}-master-list.xlsx')
+        return today_df.reindex(columns=restricted.master_list_columns(constants)), path, constants
+
+    return {
+        'get_securities': (read_holds, lambda holds: perf.get_securities(holds, pd.DataFrame(columns=holdings_columns))),
+        'get_countries_weighted': (read_holds, perf.get_countries_weighted),
+        'update_alloc': (setup_alloc, lambda args: perf.update_alloc(args[0], args[1].copy())),
+        'create_chars_excel': (setup_chars, lambda args: perf.create_chars_excel(*args)),
+        'copy_cells': (setup_copy, lambda args: perf.copy_cells(*args)),
+        'add_drop': (lambda files, size: make_master_lists(size), lambda args: restricted.make_add_drop(*args)),
+        'export_master_list': (setup_export, lambda args: restricted.export_master_list(*args, fmt='xlsx')),
+    }
+
+
+def measure(setup, run, files, size, memory=True):
+    """
+    Times one stage and measures its peak memory, each in its own run so tracing doesn't slow the timing.
+
+    Args:
+        setup (function): The stage's setup function.
+        run (function): The stage's run function.
+        files (dict): The generated files, see generate.
+        size (int): The number of holdings rows.
+        memory (bool): Whether to measure the peak memory.
+
+    Returns:
+        result (dict): The 'seconds' the stage took and its 'peak_mb' (None if not measured).
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        args = setup(files, size)
+        start = time.perf_counter()
+        run(args)
+        seconds = time.perf_counter() - start
+
+        peak_mb = None
+        if memory:
+            args = setup(files, size)
+            tracemalloc.start()
+            try:
+                run(args)
+                peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            finally:
+                tracemalloc.stop()
+
+    return {'seconds': seconds, 'peak_mb': peak_mb}
+
+
+def cold_start(command, repeat=3):
+    """
+    Times a command in a fresh Python interpreter, the best of a few runs so the files are in the OS cache.
+
+    Args:
+        command (list of str): The interpreter's arguments, see COLD_START.
+        repeat (int): The number of runs.
+
+    Returns:
+        result (dict): The 'seconds' of the fastest run, and a 'peak_mb' of None.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *command], cwd=HERE, check=True, stdout=subprocess.DEVNULL)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return {'seconds': best, 'peak_mb': None}
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compares benchmark results against a baseline.
+
+    Args:
+        results (dict): The results, keyed by stage and then size (as a string, or 'startup' for the cold start stages).
+        baseline (dict): The baseline results, in the same shape.
+        tolerance (float): How many times slower or larger than the baseline a stage may be.
+
+    Returns:
+        regressions (list of str): A description of each stage and size that regressed.
+    """
+    regressions = []
+    for stage, sizes in results.items():
+        for size, result in sizes.items():
+            base = baseline.get(stage, {}).get(size)
+            if base is None:
+                continue
+            size = f"{size} rows" if size.isdigit() else size
+            if result['seconds'] > base['seconds'] * tolerance and result['seconds'] - base['seconds'] > NOISE_SECONDS:
+                regressions.append(f"{stage} at {size}: {result['seconds']:.3f}s vs {base['seconds']:.3f}s")
+            if (result['peak_mb'] is not None and base.get('peak_mb') is not None
+                    and result['peak_mb'] > base['peak_mb'] * tolerance and result['peak_mb'] - base['peak_mb'] > NOISE_MB):
+                regressions.append(f"{stage} at {size}: {result['peak_mb']:.1f} MB vs {base['peak_mb']:.1f} MB")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--sizes', type=int, nargs='*', default=DEFAULT_SIZES, help='holdings rows to benchmark')
+    parser.add_argument('--stages', nargs='+', help='only run these stages')
+    parser.add_argument('--data-dir', default=DEFAULT_DATA_DIR, help='where the synthetic files are generated')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline file to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='record these results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='allowed slowdown factor')
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory runs')
+    args = parser.parse_args(argv)
+
+    perf = load_script('perf_sheet', 'evest-to-perf-sheet.py')
+    restricted = load_script('restricted_list', 'generate-excel')
+    metrics.configure(None)  # The scripts' own metrics files aren't written while benchmarking
+    selected = stages(perf, restricted)
+    if args.stages:
+        selected = {name: selected[name] for name in args.stages if name not in COLD_START}
+
+    results = {name: {} for name in selected}
+    for size in args.sizes:
+        start = time.perf_counter()
+        files = generate(size, args.data_dir)
+        print(f"{size} rows: inputs ready in {time.perf_counter() - start:.1f}s")
+        for name, (setup, run) in selected.items():
+            result = measure(setup, run, files, size, memory=not args.no_memory)
+            results[name][str(size)] = result
+            peak = f"{result['peak_mb']:9.1f} MB" if result['peak_mb'] is not None else ''
+            print(f"  {name:<24}{result['seconds']:10.3f}s{peak}")
+
+    starts = [name for name in COLD_START if not args.stages or name in args.stages]
+    if starts:
+        print("Cold start:")
+    for name in starts:
+        results[name] = {'startup': cold_start(COLD_START[name])}
+        print(f"  {name:<24}{results[name]['startup']['seconds']:10.3f}s")
+
+    status = 0
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            status = 1
+        else:
+            print("No regressions against the baseline")
+    elif not args.save_baseline:
+        print(f"No baseline at {args.baseline} to compare against, record one with --save-baseline")
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        for name, sizes in results.items():
+            baseline.setdefault(name, {}).update(sizes)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"Saved baseline to {args.baseline}")
+
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,172 @@
+"""
+Command line entry points of the restricted list (generate-excel) and the perf sheet (evest-to-perf-sheet.py).
+
+Usage:
+    restricted-list build                       # the Add/Drop lists and master list, with the settings in generate-excel
+    restricted-list build --ingest drop         # wait for a saved Enfusion export instead of driving Excel
+    perf-sheet build                            # every out of date stage of the portfolio in evest-to-perf-sheet.py
+    perf-sheet build --stage holdings --stage allocations --rerun
+    perf-sheet build --manifest portfolios.json --workers 4
+
+Both scripts are notebook exports whose names can't be imported, so importing this module also makes them
+importable as 'restricted_list' and 'perf_sheet' (see ScriptFinder). Parsing the arguments only needs the
+standard library: pandas, openpyxl and the rest of a script's dependencies load once its command runs, and
+pyautogui only when Excel is driven, so a headless run or --help starts right away.
+"""
+
+# For parsing the arguments
+import argparse
+import importlib
+import importlib.abc
+import importlib.machinery
+import importlib.util
+import os
+import sys
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Module name of each script, and its file name relative to this file
+SCRIPTS = {
+    'restricted_list': 'generate-excel',
+    'perf_sheet': 'evest-to-perf-sheet.py',
+}
+
+
+class ScriptFinder(importlib.abc.MetaPathFinder):
+    """
+    Finds the scripts of SCRIPTS when their module name is imported.
+
+    Since the finder is installed whenever this module is imported, worker processes started with spawn can
+    unpickle the scripts' functions too.
+    """
+
+    def find_spec(self, name, path=None, target=None):
+        """
+        Gets the spec of a script's module.
+
+        Args:
+            name (str): The full name of the module being imported.
+            path (list of str): The parent package's path, unused since the scripts are top level modules.
+            target (module): The module being reloaded, if any.
+
+        Returns:
+            spec (importlib.machinery.ModuleSpec): The script's spec, or None for any other module or if the
+            script isn't next to this file.
+        """
+        if name not in SCRIPTS:
+            return None
+        file_name = os.path.join(HERE, SCRIPTS[name])
+        if not os.path.exists(file_name):
+            return None
+        return importlib.util.spec_from_file_location(name, file_name,
+                                                      loader=importlib.machinery.SourceFileLoader(name, file_name))
+
+
+if not any(isinstance(finder, ScriptFinder) for finder in sys.meta_path):
+    sys.meta_path.append(ScriptFinder())
+
+# The scripts import the modules next to them
+if HERE not in sys.path:
+    sys.path.insert(0, HERE)
+
+
+def load_script(name):
+    """
+    Imports one of the scripts as a module, without running its notebook cells.
+
+    The scripts hold their own settings, so they aren't installed with the package and are only found next
+    to this file, in a checkout installed with 'pip install -e .'.
+
+    Args:
+        name (str): The script's module name, see SCRIPTS.
+
+    Returns:
+        module (module): The imported script.
+
+    Raises:
+        ImportError: If the script isn't next to this file, e.g. after a regular 'pip install .'.
+    """
+    file_name = os.path.join(HERE, SCRIPTS[name])
+    if not os.path.exists(file_name):
+        raise ImportError(f"{SCRIPTS[name]} isn't next to {os.path.abspath(__file__)}. The scripts and their "
+                          f"settings aren't installed with the package, so install the checkout holding them "
+                          f"with 'pip install -e .' or run 'python cli.py' from it", name=name, path=file_name)
+    return importlib.import_module(name)
+
+
+def restricted_list(argv=None):
+    """
+    Runs the restricted-list command.
+
+    Args:
+        argv (list of str): The arguments. Defaults to the command line's.
+
+    Returns:
+        status (int): The exit status.
+    """
+    parser = argparse.ArgumentParser(prog='restricted-list', description='Build the restricted list from Enfusion '
+                                     'and the XXXXXXXXXXX sources, with the settings in generate-excel.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help="build today's master list and its Add, Drop and Changes files")
+    build.add_argument('--ingest', choices=['excel', 'drop'],
+                       help="'excel' to drive Excel to pull the Enfusion data, 'drop' to wait for a saved export")
+    build.add_argument('--no-store', action='store_true',
+                       help="diff against the previous master list file instead of the SQLite store")
+    args = parser.parse_args(argv)
+
+    try:
+        script = load_script('restricted_list')
+    except ImportError as e:
+        parser.exit(1, f"restricted-list: {e}\n")
+    if args.ingest is not None:
+        script.ingest_mode = args.ingest
+    if args.no_store:
+        script.restricted_db = None
+    script.build_restricted_list()
+    return 0
+
+
+def perf_sheet(argv=None):
+    """
+    Runs the perf-sheet command.
+
+    Args:
+        argv (list of str): The arguments. Defaults to the command line's.
+
+    Returns:
+        status (int): The exit status, 1 if any portfolio failed.
+    """
+    parser = argparse.ArgumentParser(prog='perf-sheet', description='Build the perf sheet of the portfolio set up '
+                                     'in evest-to-perf-sheet.py, or of every portfolio in a manifest.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='run the out of date stages and save the output workbook')
+    build.add_argument('--stage', action='append', dest='stages', metavar='STAGE',
+                       help='only run this stage (holdings, performance, allocations or characteristics), repeatable')
+    build.add_argument('--rerun', action='store_true', help="rerun the stages even if they're up to date")
+    build.add_argument('--manifest', help='JSON manifest of portfolios to run in parallel instead')
+    build.add_argument('--workers', type=int, help='processes running the manifest, defaults to the number of cores')
+    args = parser.parse_args(argv)
+
+    try:
+        script = load_script('perf_sheet')
+    except ImportError as e:
+        parser.exit(1, f"perf-sheet: {e}\n")
+    unknown = [stage for stage in args.stages or [] if stage not in script.PERF_STAGES]
+    if unknown:
+        parser.error(f"unknown stage {', '.join(unknown)}, use {', '.join(script.PERF_STAGES)}")
+
+    rerun = True if args.rerun else None
+    if args.manifest is not None:
+        results = script.run_batch(script.load_manifest(args.manifest), args.workers, rerun=rerun, stages=args.stages)
+    else:
+        results = [script.run_portfolio(script.portfolio, rerun=rerun, stages=args.stages)]
+        script.print_result(results[0])
+    return int(any(result['status'] != 'ok' for result in results))
+
+
+if __name__ == '__main__':
+    commands = {'restricted-list': restricted_list, 'perf-sheet': perf_sheet}
+    if len(sys.argv) < 2 or sys.argv[1] not in commands:
+        sys.exit(f"usage: python cli.py {{{','.join(commands)}}} ...")
+    sys.exit(commands[sys.argv[1]](sys.argv[2:]))
@@ -7,16 +7,61 @@
 # Where your data is stored
 data_loc = "##############################"
 
+# Read the source workbooks in read-only mode, keeping only the values the pipeline uses
+stream_sources = True
+
+# Stream the rows of the Holdings sheet straight into the saved file instead of building them as openpyxl cells
+stream_holdings = True
+
+# Input and output files of the portfolio, relative to data_loc
+portfolio = {
+    'name': "##############################",
+    'output': "##############################",
+    'holdings': "##############################",
+    'performance': "##############################",  # The last day of the previous month and '.xlsx' are added to this
+    'allocations': "##############################",
+    'characteristics': "##############################",
+    'market_caps': "##############################",
+}
+
+# Column of the holdings file with each security's market cap in USD, which the market cap buckets are computed from.
+# The buckets are read from the portfolio's market_caps file instead if the holdings file doesn't have it
+market_cap_column = 'Mkt Cap'
+
+# Market cap buckets of the characteristics sheet, largest first, each with its lower edge in USD. They fill the
+# template's rows from B57 down (it has room for five), and securities worth market_cap_upper or more are in none
+market_cap_buckets = [('7.5-15B', 7.5e9), ('1.5-7.5B', 1.5e9), ('750M-1.5B', 750e6), ('400-750M', 400e6), ('<400M', 0)]
+market_cap_upper = 15e9
+
+# JSON manifest (a list of portfolios like the one above) to run in parallel instead, None to only run the portfolio above
+batch_manifest = None
+
+# Rerun every stage, even the ones whose input files and code haven't changed since the last run
+rerun_all = False
+
+# JSON lines file each stage's time, memory, rows and errors are appended to, None to not record them
+metrics_file = data_loc + 'perf-sheet-metrics.jsonl'
+
+# None, 'cprofile' to also save a cProfile of each portfolio run next to the metrics file,
+# or 'tracemalloc' to also record each stage's peak Python memory (slower)
+profile_mode = None
+
+# Directory of the store each run's holdings, performance and allocation frames are added to, None to not keep them
+snapshot_dir = data_loc + 'snapshots/'
+
 
 # In[2]:
 
 
 # For DataFrames
 import pandas as pd
+import numpy as np
 
 # For Excel Editing
 from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
-from openpyxl import Workbook, load_workbook
+from openpyxl import load_workbook
+from openpyxl.utils import get_column_letter, column_index_from_string
+from openpyxl.cell.cell import MergedCell
 
 # To Get the last day of the previous month
 from datetime import date, datetime, timedelta
@@ -27,6 +72,43 @@ import os
 # For copying the spreadsheet to another spreadsheet
 from copy import copy
 
+# For caching lookups on worksheets for as long as the workbook is alive
+from weakref import WeakKeyDictionary
+
+# For keeping the largest weights without sorting all of them
+import heapq
+
+# For reporting how long the source workbooks take to load
+import time
+
+# For running many portfolios at once
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# For skipping the Excel parsing of input files that haven't changed
+from excel_cache import read_excel_cached, file_hash
+
+# For skipping the stages whose input files and code haven't changed
+import hashlib
+import inspect
+
+# For streaming large sheets into the saved workbook
+from xlsx_stream import write_streamed_sheets
+import shutil
+import zipfile
+import io
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+from openpyxl.cell.cell import Cell, ILLEGAL_CHARACTERS_RE
+from openpyxl.utils.datetime import to_excel
+
+# For recording each stage's time, memory, rows and errors
+import metrics
+metrics.configure(metrics_file, profile=profile_mode)
+
+# For keeping each run's frames for reports over many months
+import snapshot_store
+
 
 # In[ ]:
 
@@ -51,39 +133,77 @@ def EOPM():
 
     return last_day_prev_month
 
+# Columns of the extracted holdings frame, as written to the 'Holdings' sheet, with their dtypes. The repetitive
+# columns are categorical and the numbers are floats, the identifiers and names are left as they are read
+HOLDINGS_SCHEMA = {
+    'Identifier': None,
+    'Identifier Type': 'category',
+    'Ticker': None,
+    'Security Name': None,
+    'Security Type': 'category',
+    '# of Shares': 'float64',
+    'Security Price': 'float64',
+    'Weight (%)': 'float64',
+    'Country': 'category',
+    'Market Value': 'float64',
+}
+HOLDINGS_COLUMNS = list(HOLDINGS_SCHEMA)
+
+def apply_holdings_schema(df):
+    """
+    Gives the extracted holdings frame the columns and dtypes of HOLDINGS_SCHEMA.
+
+    Numbers that can't be parsed become NaN rather than leaving the whole column as objects.
+
+    Args:
+        df (pandas.DataFrame): The extracted holdings.
+
+    Returns:
+        df (pandas.DataFrame): The holdings with the schema's columns, in its order and with its dtypes.
+    """
+    df = df.reindex(columns=HOLDINGS_COLUMNS)
+    for column, dtype in HOLDINGS_SCHEMA.items():
+        if dtype == 'category':
+            df[column] = df[column].astype('category')
+        elif dtype is not None:
+            df[column] = pd.to_numeric(df[column], errors='coerce').astype(dtype)
+    return df
+
 def insert_cash_row(df):
     """
     Inserts a row for cash holdings in a DataFrame.
 
     This function identifies the row in the DataFrame where the 'Identifier' column is NaN (representing cash), 
-    creates a new row for cash holdings with specific values, removes the original cash row, and 
-    appends the new row to the DataFrame. The DataFrame is then sorted by the 'Security Name' column.
+    and replaces it with a row for cash holdings with specific values. The rows keep the order of the holdings
+    file and the result keeps the dtypes of HOLDINGS_SCHEMA.
 
     Args:
         df (pandas.DataFrame): The DataFrame containing the holdings data, including a row for cash with NaN 'Identifier'.
 
     Returns:
-        df (pandas.DataFrame): The updated DataFrame with the new cash row inserted and sorted by 'Security Name'.
+        df (pandas.DataFrame): The updated DataFrame with the new cash row in place of the original one.
     """
-    
-    idx = df['Identifier'].isna().idxmax()
-    cash = df.iloc[idx]
-    new_row = ['CASH', 'CASH', 'USD', 'US DOLLAR', 'Cash', cash['# of Shares'],
-           cash['Security Price'], cash['Weight (%)'], 'United States', cash['Market Value']]
-    df.drop(idx, inplace=True)
-    df = df.reset_index(drop = True)
-    df.loc[len(df)] = new_row
-    df = df.sort_values(by='Security Name')
-
-
+    is_cash = df['Identifier'].isna().to_numpy()
+    if not is_cash.any():
+        return df
+
+    position = int(is_cash.argmax())
+    cash = df.iloc[position]
+    new_row = pd.DataFrame([['CASH', 'CASH', 'USD', 'US DOLLAR', 'Cash', cash['# of Shares'],
+                             cash['Security Price'], cash['Weight (%)'], 'United States', cash['Market Value']]],
+                           columns=HOLDINGS_COLUMNS)
+    df = pd.concat([df.iloc[:position], new_row, df.iloc[position + 1:]], ignore_index=True)
+    return apply_holdings_schema(df)
+
+@metrics.instrument()
 def get_securities(holds, df):
     """
     Extracts securities and their associated countries from the holdings DataFrame.
 
-    This function processes a holdings DataFrame to identify rows representing securities 
-    (determined by non-null values in the 3rd column). It backtracks from each security 
-    row to find the most recent country (determined by non-null values in the 2nd column) 
-    and compiles this information into a new DataFrame.
+    This function processes a holdings DataFrame to identify rows representing securities
+    (determined by non-null values in the 3rd column). Each security takes the most recent
+    country above it (determined by non-null values in the 2nd column), which is found by
+    forward-filling the country header rows, so the whole frame is built in one pass.
 
     Args:
         holds (pandas.DataFrame): DataFrame containing various data including securities and country information.
@@ -92,24 +212,33 @@ def get_securities(holds, df):
     Returns:
         df (pandas.DataFrame): DataFrame that contains all the securities with their respective countries.
     """
-    
-    for index, row in holds.iterrows():
-    
-    # Only if it's an actual security
-        if pd.notna(row['Unnamed: 2']):
-        
-            # Getting Country
-            country_index = index - 1
-            while holds.isna().iloc[country_index]['Unnamed: 1']:
-                country_index -= 1
-            country = holds.iloc[country_index]['Unnamed: 1']
-    
-            # New row in new dataframe
-            df.loc[len(df)] = [row['ISIN'], 'ISIN', row['Ticker'], row['Unnamed: 2'], 'Common Stock',
-                               row['Pos'], row['Px Close'], row['% Wgt'], country.upper(), row['Mkt Val']]
-            
-    return df
 
+    # Country header rows carried down to the rows below them (shifted so a row never uses its own country)
+    countries = holds['Unnamed: 1'].ffill().shift(1)
+
+    # Only if it's an actual security
+    mask = holds['Unnamed: 2'].notna()
+    secs = holds[mask]
+
+    # New rows for the new dataframe, built column by column
+    rows = pd.DataFrame({
+        df.columns[0]: secs['ISIN'].values,
+        df.columns[1]: 'ISIN',
+        df.columns[2]: secs['Ticker'].values,
+        df.columns[3]: secs['Unnamed: 2'].values,
+        df.columns[4]: 'Common Stock',
+        df.columns[5]: secs['Pos'].values,
+        df.columns[6]: secs['Px Close'].values,
+        df.columns[7]: secs['% Wgt'].values,
+        df.columns[8]: countries[mask].str.upper().values,
+        df.columns[9]: secs['Mkt Val'].values,
+    })
+
+    if len(df) == 0:
+        return apply_holdings_schema(rows)
+    return apply_holdings_schema(pd.concat([df, rows], ignore_index=True))
+
+@metrics.instrument()
 def extract_perf_info(perf, df):
     """
     Extracts performance information for specific strategies and append it to a DataFrame.
@@ -144,16 +273,98 @@ def extract_perf_info(perf, df):
     df.set_index('Strategy', inplace=True)
     return df
 
+def cash_mask(df):
+    """
+    Finds the cash rows of the extracted holdings frame.
+
+    Cash is the 'US Dollar Spot' row of the holdings export, or a row whose 'Security Type' is 'Cash'.
+
+    Args:
+        df (pandas.DataFrame): The extracted holdings, with the columns in HOLDINGS_COLUMNS.
+
+    Returns:
+        mask (pandas.Series): True for the cash rows.
+    """
+    return df['Security Name'].str.contains('US Dollar Spot', na=False) | df['Security Type'].eq('Cash')
+
+@metrics.instrument()
+def get_weights(df, breakdowns, weight='Weight (%)', decimals=2):
+    """
+    Calculates cash-adjusted weights of the holdings broken down by any number of dimensions.
+
+    The cash rows (see cash_mask) are left out and every other weight is scaled up so that they add up
+    to 100 without cash. This is done once, then each breakdown is a single groupby of the scaled weights,
+    so adding a breakdown doesn't need another pass over a sheet.
+
+    Args:
+        df (pandas.DataFrame): The extracted holdings, with the columns in HOLDINGS_COLUMNS.
+        breakdowns (dict): A dictionary where keys are the names of the breakdowns and values are what to group by:
+        a column name (e.g. 'Country'), a Series aligned with df (e.g. market cap buckets), or a function taking df
+        and returning such a Series.
+        weight (str): The column of the weights, in percent.
+        decimals (int): The number of decimals the weights are rounded to, None to not round them.
+
+    Returns:
+        weights (dict): A dictionary where keys are the names of the breakdowns and values are Series of the
+        weights in percent, indexed by group in order of first appearance.
+    """
+    cash = cash_mask(df)
+    scale = 100 / (100 - df.loc[cash, weight].sum())
+    invested = df[~cash]
+    adjusted = invested[weight].astype(float) * scale
+
+    weights = {}
+    for name, key in breakdowns.items():
+        if callable(key):
+            key = key(df)
+        if isinstance(key, pd.Series):
+            key = key[~cash]
+        else:
+            key = invested[key]
+        weights[name] = adjusted.groupby(key, sort=False, observed=True).sum()
+        if decimals is not None:
+            weights[name] = weights[name].round(decimals)
+    return weights
+
+def get_market_cap_weights(holds, buckets=None, upper=None):
+    """
+    Calculates the cash-adjusted weights of the holdings in each market cap bucket.
+
+    Each security is binned by the market cap in the 'market_cap_column' of the holdings, in one vectorized pass,
+    and the weights are summed by bucket (see get_weights).
+
+    Args:
+        holds (pandas.DataFrame): DataFrame containing holdings data, including the market cap column.
+        buckets (list of tuple): The buckets, largest first, as (label, lower edge) pairs. Defaults to the
+        'market_cap_buckets' setting.
+        upper (float): The upper edge of the largest bucket. Defaults to the 'market_cap_upper' setting.
+
+    Returns:
+        caps (dict): A dictionary where keys are the bucket labels, largest first, and values are their weighted percentages.
+    """
+    buckets = market_cap_buckets if buckets is None else buckets
+    upper = market_cap_upper if upper is None else upper
+
+    secs = get_securities(holds, pd.DataFrame(columns=HOLDINGS_COLUMNS))
+    values = pd.to_numeric(holds.loc[holds['Unnamed: 2'].notna(), market_cap_column], errors='coerce')
+    edges = [lower for _, lower in reversed(buckets)] + [upper]
+    labels = [label for label, _ in reversed(buckets)]
+    bucket = pd.cut(pd.Series(values.to_numpy(), index=secs.index), bins=edges, labels=labels, right=False)
+
+    weights = get_weights(secs, {'market_cap': bucket}, decimals=None)['market_cap']
+    return {label: weights.get(label, 0.0) for label, _ in buckets}
+
+@metrics.instrument()
 def get_countries_weighted(holds):
     """
     Calculates weighted percentages for countries based on holdings data.
 
-    This function calculates the weighted percentages for each country based on the provided holdings DataFrame.
-    It first determines the weight of cash in the holdings, then calculates the weight for each country excluding cash.
+    This function extracts the securities from the holdings (see get_securities) and sums their
+    cash-adjusted weights by country (see get_weights).
     
-    Note that 'Unnamed: 1' is for country names and '% Wgt' is for weights, and that Cash is identified by rows
-    containing 'US Dollar Spot', and its weight is used to calculate country weights. Also, the returned dictionary
-    excludes the 'Not Classified' category (which is USD).
+    Note that 'Unnamed: 1' is for country names, and that the countries keep the names they have there rather than
+    the upper case ones of the 'Holdings' sheet. Also, the returned dictionary excludes the 'Not Classified' category
+    (which is USD).
     
     Args:
         holds (pandas.DataFrame): DataFrame containing holdings data including countries and their weights.
@@ -161,58 +372,371 @@ def get_countries_weighted(holds):
     Returns:
         countries (dict): A dictionary where keys are country names and values are their weighted percentages.
     """
-    # Getting Cash/Weight Makeup using boolean mask on DataFrame
-    mask = holds['Unnamed: 2'].str.contains('US Dollar Spot', na=False)
-    result = holds[mask]
-    cash = list(holds.iloc[result.index]['% Wgt'])[0]
-    weight = 1 / ((100 - cash) * 0.01)
+    secs = get_securities(holds, pd.DataFrame(columns=HOLDINGS_COLUMNS))
+    weights = get_weights(secs, {'country': 'Country'})['country']
 
-    # Getting countries
-    countries = {}
-    for index, row in holds.iterrows():
-        
-        # Only if it's a country, not security
-        if pd.notna(row['Unnamed: 1']):
-            countries[row['Unnamed: 1']] = round(row['% Wgt'] * weight, 2)
-    
-    del countries['Not Classified']
+    names = {name.upper(): name for name in holds['Unnamed: 1'].dropna()}
+    countries = {names.get(country, country): value for country, value in weights.items()}
+    countries.pop('Not Classified', None)
     return countries
 
+# Title rows of the allocation sheet, these are regions rather than countries
+ALLOC_TITLES = ['North America', 'United Kingdom', 'Euroland (EU) Countries', 'Non-Euroland (EU) Countries',
+                'Far East & Australasia', 'Other', 'Latin America', 'Africa/Middle East', 'Eastern Europe',
+                'Far East ex-China', 'China', 'Other Emerging Markets', 'Emerging Market Total']
+
+class CountryMatcher:
+    """
+    Finds every country name that appears in a piece of text with a single scan of the text.
+
+    The names are compiled into an Aho-Corasick automaton, so matching a market name against all the
+    countries at once costs about the length of the market name instead of one substring search per country.
+
+    Args:
+        names (iterable of str): The country names to search for.
+    """
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+
+        # Trie of the names
+        for i, name in enumerate(self.names):
+            state = 0
+            for char in name:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.out[state].append(i)
+
+        # Failure links, breadth first so every state's fallback is done before its children
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, child in self.goto[state].items():
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+                queue.append(child)
+
+    def find(self, text):
+        """
+        Finds the country names contained in a piece of text.
+
+        Args:
+            text (str): The text to search.
+
+        Returns:
+            found (set): The indexes (in the order they were given) of the names found in the text.
+        """
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            found.update(self.out[state])
+        return found
+
+def match_countries(countries, markets):
+    """
+    Matches country names to the rows of the 'Market' column that contain them, excluding title rows.
+
+    Every market name is scanned once with a CountryMatcher, so the work grows with the number of
+    markets rather than with countries times markets.
+
+    Args:
+        countries (iterable of str): The country names to match.
+        markets (pandas.Series): The 'Market' column of the allocation data.
+
+    Returns:
+        matches (dict): A dictionary where keys are country names and values are lists of the positions
+        of the market rows containing them, in row order.
+        ambiguous (dict): A dictionary where keys are market names matched by more than one country and
+        values are the list of those countries.
+    """
+    names = list(countries)
+    matcher = CountryMatcher(names)
+    matches = {name: [] for name in names}
+    ambiguous = {}
+    titles = set(ALLOC_TITLES)
+
+    for pos, market in enumerate(markets):
+        if not isinstance(market, str) or market in titles:
+            continue
+        found = matcher.find(market)
+        for i in sorted(found):
+            matches[names[i]].append(pos)
+        if len(found) > 1:
+            ambiguous[market] = [names[i] for i in sorted(found)]
+
+    return matches, ambiguous
+
+@metrics.instrument()
 def update_alloc(countries, alloc):
     """
     Updates the 'Country (%)' column in a DataFrame containing allocation data based on country names and their percentages.
     
     Iterates through each country in the 'countries' dictionary (key: country name, value: percentage).
-    For each country, it searches for its presence in the 'Market' column of the DataFrame 'alloc' and updates the
-    corresponding 'Country (%)' value if the country is found and the 'Country (%)' value is not already present.
+    For each country, it looks up the rows of the 'Market' column of the DataFrame 'alloc' containing it (see
+    match_countries) and updates the first one's 'Country (%)' value if the country is found and one of the
+    'Country (%)' values is already present. Countries with no market and markets matched by several countries
+    are reported.
 
     Parameters:
+        countries (dict): A dictionary where keys are country names and values are their weighted percentages.
         alloc (pd.DataFrame): DataFrame containing allocation data with columns like 'Market' and 'Country (%)'.
 
     Returns:
         alloc (pd.DataFrame): Updated DataFrame with 'Country (%)' column values updated based on the specified countries and their percentages.
     """
-    titles = ['North America', 'United Kingdom', 'Euroland (EU) Countries', 'Non-Euroland (EU) Countries',
-              'Far East & Australasia', 'Other', 'Latin America', 'Africa/Middle East', 'Eastern Europe',
-              'Far East ex-China', 'China', 'Other Emerging Markets', 'Emerging Market Total']
-    for country in countries.items():
-        mask = (alloc['Market'].str.contains(country[0], na=False, regex=False) & ~alloc['Market'].isin(titles))
-        result = alloc[mask]
-        if (pd.notna(alloc.loc[result.index, 'Country (%)']).any()):
-            alloc.loc[result.index[0], 'Country (%)'] = country[1]
+    matches, ambiguous = match_countries(countries, alloc['Market'])
+    if pd.api.types.is_integer_dtype(alloc['Country (%)']):
+        alloc['Country (%)'] = alloc['Country (%)'].astype(float)  # So rounded weights can be written into it
+    present = alloc['Country (%)'].notna().to_numpy(copy=True)
+
+    for country, value in countries.items():
+        rows = matches[country]
+        if present[rows].any():
+            alloc.loc[alloc.index[rows[0]], 'Country (%)'] = value
+            present[rows[0]] = pd.notna(value)
+
+    unmatched = [country for country, rows in matches.items() if not rows]
+    if unmatched:
+        print(f"No market found for: {', '.join(unmatched)}")
+    for market, names in ambiguous.items():
+        print(f"Market '{market}' matches several countries: {', '.join(names)}")
+
     return alloc
 
-def create_holds_excel(df, file_name):
+def sheet_rows_xml(frame, start_row, date_style):
+    """
+    Generates the worksheet XML of a DataFrame's rows, one row at a time.
+
+    Strings are written inline so the workbook's shared strings don't change, and empty values are left out.
+
+    Args:
+        frame (pandas.DataFrame): The rows to write, without its index or header.
+        start_row (int): The sheet row of the first row.
+        date_style (int): The style id given to dates and times.
+
+    Returns:
+        rows (generator of str): The <row> element of each row.
+    """
+    letters = [get_column_letter(c) for c in range(1, len(frame.columns) + 1)]
+    for r_idx, row in enumerate(frame.itertuples(index=False, name=None), start=start_row):
+        cells = []
+        for letter, value in zip(letters, row):
+            if value is None or (not isinstance(value, str) and pd.isna(value)):
+                continue
+            ref = f'{letter}{r_idx}'
+            if isinstance(value, (bool, np.bool_)):
+                cells.append(f'<c r="{ref}" t="b"><v>{int(value)}</v></c>')
+            elif isinstance(value, (int, float, np.number)) and np.isfinite(value):
+                cells.append(f'<c r="{ref}"><v>{value!r}</v></c>' if isinstance(value, float) else f'<c r="{ref}"><v>{value}</v></c>')
+            elif isinstance(value, (datetime, date)):
+                cells.append(f'<c r="{ref}" s="{date_style}"><v>{to_excel(value)}</v></c>')
+            else:
+                text = escape(ILLEGAL_CHARACTERS_RE.sub('', str(value)))
+                space = ' xml:space="preserve"' if text != text.strip() else ''
+                cells.append(f'<c r="{ref}" t="inlineStr"><is><t{space}>{text}</t></is></c>')
+        yield f'<row r="{r_idx}">{"".join(cells)}</row>'
+
+# Namespaces of the workbook part and its relationships, for finding the part of each sheet
+XLSX_NS = {'main': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main',
+           'rels': 'http://schemas.openxmlformats.org/package/2006/relationships'}
+XLSX_RID = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'
+
+# A sheet without any cells, put in place of the sheets that are about to be replaced
+EMPTY_SHEET_XML = '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData/></worksheet>'
+
+def sheet_parts(archive):
+    """
+    Finds the part of an .xlsx file holding each of its sheets, from the workbook part alone.
+
+    Args:
+        archive (zipfile.ZipFile): The opened .xlsx file.
+
+    Returns:
+        parts (dict): The part of each sheet by sheet name, e.g. {'Holdings': 'xl/worksheets/sheet1.xml'}, in the workbook's order.
+    """
+    workbook = ET.fromstring(archive.read('xl/workbook.xml'))
+    rels = ET.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+    targets = {rel.get('Id'): rel.get('Target') for rel in rels.findall('rels:Relationship', XLSX_NS)}
+    parts = {}
+    for sheet in workbook.findall('main:sheets/main:sheet', XLSX_NS):
+        target = targets[sheet.get(XLSX_RID)]
+        parts[sheet.get('name')] = target[1:] if target.startswith('/') else 'xl/' + target
+    return parts
+
+def sheet_names(file_name):
+    """
+    Gets the names of an output file's sheets without loading any of them.
+
+    Args:
+        file_name (str): The name of the Excel file, relative to data_loc.
+
+    Returns:
+        names (list of str): The names of the sheets, empty if the file doesn't exist yet.
     """
-    Creates an Excel file with formatted holdings data.
+    if not os.path.exists(data_loc + file_name):
+        return []
+    with zipfile.ZipFile(data_loc + file_name) as archive:
+        return list(sheet_parts(archive))
 
-    This function writes a DataFrame to an Excel file, applying specific formatting 
-    to ensure column names are visible and have consistent styling. The file is appended 
-    to an existing Excel workbook using the 'openpyxl' engine.
+def read_without_sheets(path, names):
+    """
+    Reads an .xlsx file into memory with some of its sheets emptied, so loading it never parses the
+    sheets that are about to be replaced, however many rows they have.
+
+    Args:
+        path (str): The path to the .xlsx file.
+        names (list of str): The names of the sheets to empty. Names the file has no sheet for are ignored.
+
+    Returns:
+        buffer (io.BytesIO): The file's contents.
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(path) as source, zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as target:
+        parts = sheet_parts(source)
+        emptied = {parts[name] for name in names if name in parts}
+        for item in source.infolist():
+            if item.filename in emptied:
+                target.writestr(item.filename, EMPTY_SHEET_XML)
+                continue
+            with source.open(item) as src, target.open(item, 'w') as dst:
+                shutil.copyfileobj(src, dst)
+    buffer.seek(0)
+    return buffer
+
+class WorkbookSession:
+    """
+    Collects every sheet write and formatting step for one output workbook and saves it once.
+
+    The workbook is parsed when the session is created and written back to disk when save is called,
+    instead of once per sheet. The sheets the session is going to replace are emptied before the workbook
+    is parsed, so a large sheet from the last run costs nothing to throw away. Sheets are written through
+    `writer`, a pandas ExcelWriter that replaces existing sheets, and the openpyxl Workbook behind it is
+    available as `book`. Large sheets can instead have their rows streamed into the saved file (see
+    stream_rows), without ever being cells.
+
+    Args:
+        file_name (str): The name of the Excel file the sheets are written to. It should include the extension.
+        replace (list of str): The sheets that will be replaced, which aren't parsed. The others are kept as they are.
+    """
+
+    def __init__(self, file_name, replace=()):
+        self.file_name = file_name
+        self.streams = []
+        try:
+            if os.path.exists(data_loc + file_name):
+                self.buffer = read_without_sheets(data_loc + file_name, replace)
+                self.writer = pd.ExcelWriter(self.buffer, engine='openpyxl', mode='a', if_sheet_exists='replace')
+            else:
+                self.buffer = io.BytesIO()
+                self.writer = pd.ExcelWriter(self.buffer, engine='openpyxl')
+        except PermissionError:
+            print(f"Permission denied: The file {file_name} is open. Please close the file and try again.")
+            raise
+
+    @property
+    def book(self):
+        return self.writer.book
+
+    def replace_sheet(self, sheet_name):
+        """
+        Creates an empty sheet, in place of the existing sheet with the same name if there is one.
+
+        Args:
+            sheet_name (str): The name of the sheet.
+
+        Returns:
+            worksheet (Worksheet): The empty sheet.
+        """
+        if sheet_name in self.book.sheetnames:
+            index = self.book.sheetnames.index(sheet_name)
+            self.book.remove(self.book[sheet_name])
+            return self.book.create_sheet(sheet_name, index)
+        return self.book.create_sheet(sheet_name)
+
+    def stream_rows(self, worksheet, frame, start_row=2):
+        """
+        Adds a DataFrame's rows to a sheet when the workbook is saved, written straight into the file.
+
+        The sheet itself only holds what's above the rows (e.g. a formatted header) and its column widths.
+        Once the workbook is saved, the sheet's part of the file is rewritten with the rows generated one
+        at a time (see sheet_rows_xml), so memory stays flat however many rows there are.
+
+        Args:
+            worksheet (Worksheet): The sheet, from this session's workbook.
+            frame (pandas.DataFrame): The rows to add, without its index or header.
+            start_row (int): The sheet row of the first row. Rows above it are kept from the sheet.
+
+        Returns:
+            None
+        """
+        date_cell = Cell(worksheet)
+        date_cell.number_format = 'YYYY-MM-DD HH:MM:SS'
+        self.streams.append((worksheet, frame, start_row, date_cell.style_id))
+
+    def write_streams(self, path):
+        """
+        Writes the workbook, as saved in the session's buffer, to a file with the rows added by stream_rows.
+
+        Args:
+            path (str): The path of the file to write.
+
+        Returns:
+            None
+        """
+        sheets = {}
+        for worksheet, frame, start_row, date_style in self.streams:
+            last_row = max(worksheet.max_row, start_row + len(frame) - 1)
+            last_column = get_column_letter(max(worksheet.max_column, len(frame.columns), 1))
+            sheets[worksheet.path[1:]] = (f'A1:{last_column}{last_row}', sheet_rows_xml(frame, start_row, date_style))
+        write_streamed_sheets(self.buffer, path, sheets)
+
+    def save(self):
+        """
+        Writes the workbook with all the sheets written during the session to disk.
+
+        Returns:
+            saved (bool): Whether the workbook was written.
+        """
+        path = data_loc + self.file_name
+        try:
+            self.writer.close()
+            if self.streams:
+                self.write_streams(path + '.tmp')
+            else:
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(self.buffer.getbuffer())
+            os.replace(path + '.tmp', path)
+            return True
+        except PermissionError as e:
+            metrics.record_error(e)
+            print(f"Permission denied: The file {self.file_name} is open. Please close the file and try again.")
+            return False
+
+@metrics.instrument()
+def create_holds_excel(df, session):
+    """
+    Writes the holdings data to the 'Holdings' sheet with formatting.
+
+    This function writes a DataFrame to the session's workbook, applying specific formatting 
+    to ensure column names are visible and have consistent styling. The sheet is saved
+    along with the rest of the workbook when the session is saved. With the 'stream_holdings'
+    setting only the header is written as cells and the rows are streamed in when the session is saved.
 
     Args:
         df (pandas.DataFrame): The DataFrame containing the holdings data to be written to the Excel file.
-        file_name (str): The name of the Excel file where the data will be written. It should include the path and extension.
+        session (WorkbookSession): The session for the Excel file where the data will be written.
 
     Returns:
         None
@@ -220,13 +744,15 @@ def create_holds_excel(df, file_name):
     try:
         sheet = 'Holdings'
         
-        if not os.path.exists(data_loc + file_name):
-            df.to_excel(data_loc + file_name, index=False, sheet_name=sheet, header=True)
-        
         # Formatting so that the names are all visible and columns names have the same formatting
-        writer = pd.ExcelWriter(data_loc + file_name, engine='openpyxl', mode='a', if_sheet_exists='replace')
-        df.to_excel(writer, index=False, sheet_name=sheet, header=True)
-        worksheet = writer.sheets[sheet]
+        if stream_holdings:
+            worksheet = session.replace_sheet(sheet)
+            worksheet.append(list(df.columns))
+            session.stream_rows(worksheet, df)
+        else:
+            df.to_excel(session.writer, index=False, sheet_name=sheet, header=True)
+            worksheet = session.writer.sheets[sheet]
+        metrics.count(rows=len(df), cells=df.size + len(df.columns))
         
         worksheet.column_dimensions['A'].width = 20
         worksheet.column_dimensions['B'].width = 12
@@ -240,26 +766,24 @@ def create_holds_excel(df, file_name):
             cell.alignment = Alignment(horizontal='center', vertical='bottom')
             cell.border = Border(top=None, bottom=None, left=None, right=None)
         
-        writer.close()
-        
-    except PermissionError:
-        print(f"Permission denied: The file {file_name} is open. Please close the file and try again.")
     except Exception as e:
+        metrics.record_error(e)
         print(f"An unexpected error occurred: {e}")
-        writer.close()
+        raise
 
-def create_perf_excel(df, file_name):
+@metrics.instrument()
+def create_perf_excel(df, session):
     """
-    Creates an Excel file with performance data and apply specific formatting.
+    Writes the performance data to the 'Performance' sheet and apply specific formatting.
 
-    This function writes a DataFrame to an Excel file, appending to an existing workbook. 
+    This function writes a DataFrame to the session's workbook. 
     It formats the columns for better readability and applies a percentage format to specified columns.
     Columns 'A' to 'D' are resized for better visibility, and columns 'B' and 'C' are formatted
     to display percentages.
 
     Args:
         df (pandas.DataFrame): The DataFrame containing the performance data to be written to the Excel file.
-        file_name (str): The name of the Excel file where the data will be written. It should include the path and extension.
+        session (WorkbookSession): The session for the Excel file where the data will be written.
 
     Returns:
         None
@@ -267,16 +791,11 @@ def create_perf_excel(df, file_name):
     try:
         sheet = 'Performance'
         
-        if not os.path.exists(data_loc + file_name):
-            df.to_excel(data_loc + file_name, index=False, sheet_name=sheet)
-            
-        # Creates a Pandas Excel writer using XlsxWriter as the engine
-        writer = pd.ExcelWriter(data_loc + file_name, engine='openpyxl', mode='a', if_sheet_exists='replace')
-        
-        # Converts dataframe to an XlsxWriter Excel object
-        df.to_excel(writer, sheet_name=sheet, header=True)
+        # Converts dataframe to an openpyxl Excel object
+        df.to_excel(session.writer, sheet_name=sheet, header=True)
+        metrics.count(rows=len(df), cells=df.size + len(df) + len(df.columns))
         
-        worksheet = writer.sheets['Performance']
+        worksheet = session.writer.sheets['Performance']
         worksheet.column_dimensions['A'].width = 15
         worksheet.column_dimensions['B'].width = 15
         worksheet.column_dimensions['C'].width = 15
@@ -286,24 +805,143 @@ def create_perf_excel(df, file_name):
            for cell in worksheet[col]:
                cell.number_format = '0.00%'
     
-        writer.close()
-    except PermissionError:
-        print(f"Permission denied: The file {file_name} is open. Please close the file and try again.")
     except Exception as e:
+        metrics.record_error(e)
         print(f"An unexpected error occurred: {e}")
-        writer.close()
+        raise
+
+# Formatting of the allocation sheet. Layers are applied in order, later layers overriding earlier ones,
+# and cell coordinates are relative to the data (row 1 is the first allocation row). The data starts
+# on the row after 'offset' to line it up with the template, and merges use sheet coordinates.
+ALLOC_FORMAT = {
+    'offset': 1,
+    'widths': {'A': 30, 'B': 30, 'C': 30},
+    'layers': [
+        {'font': Font(name='Tahoma', size=10)},
+        {'columns': ['B', 'C'], 'number_format': '0.00', 'alignment': Alignment(horizontal='center', vertical='center')},
+        {'title_rows': ALLOC_TITLES, 'fill': PatternFill(start_color='D3D3D3', end_color='D3D3D3', fill_type='solid'),
+         'font': Font(name='Tahoma', bold=True, size=10), 'alignment': Alignment(horizontal='center', vertical='center')},
+        {'cells': ['A1', 'A2', 'A3', 'A4', 'A5', 'A6'],
+         'fill': PatternFill(start_color='ADD8E6', end_color='ADD8E6', fill_type='solid')},
+        {'cells': ['A10', 'A14'], 'font': Font(name='Tahoma', bold=True, size=10)},
+        {'cells': ['A12'], 'alignment': Alignment(horizontal='center', vertical='center'),
+         'font': Font(name='Tahoma', size=11, bold=True, color='00008B')},
+    ],
+    'merges': ['A1:K1', 'A2:K2', 'A3:K3', 'A4:K4', 'A5:K5', 'A6:K6', 'A7:K7', 'A8:K8', 'A13:C13'],
+}
+
+def compile_format_plan(plan):
+    """
+    Compiles a formatting plan (see ALLOC_FORMAT) into a function that resolves the style of a cell.
+
+    A cell's style only depends on its column, whether its row is a title row, and whether it is one of
+    the cells named in the plan, so each distinct combination is resolved through the layers once and cached.
 
-def create_alloc_excel(alloc, file_name):
+    Args:
+        plan (dict): The formatting plan with its 'layers'.
+
+    Returns:
+        resolve (function): A function taking a column letter, a data row number and whether the row is a
+        title row, and returning a tuple of the (font, fill, number_format, alignment) for that cell.
     """
-    Creates an Excel file with allocation data and apply specific formatting.
+    layers = plan['layers']
+    named = {coord for layer in layers for coord in layer.get('cells', [])}
+    resolved = {}
+
+    def resolve(column, row, is_title):
+        coord = f'{column}{row}'
+        key = (column, is_title, coord if coord in named else None)
+        if key not in resolved:
+            style = {'font': None, 'fill': None, 'number_format': None, 'alignment': None}
+            for layer in layers:
+                if 'columns' in layer and column not in layer['columns']:
+                    continue
+                if 'title_rows' in layer and not is_title:
+                    continue
+                if 'cells' in layer and coord not in layer['cells']:
+                    continue
+                for attr in style:
+                    if attr in layer:
+                        style[attr] = layer[attr]
+            resolved[key] = (style['font'], style['fill'], style['number_format'], style['alignment'])
+        return resolved[key]
+
+    return resolve
+
+@metrics.instrument()
+def apply_format_plan(worksheet, frame, plan):
+    """
+    Writes a DataFrame to a worksheet and formats it according to a formatting plan, in a single pass.
 
-    This function writes an allocation DataFrame to an Excel file, creating or updating the 'Allocations' sheet.
-    It applies various formatting styles such as font, column width, number format, cell merging, and background colors
-    to improve readability and organization of the data.
+    Each cell is written at its final position (shifted down by the plan's 'offset') and given its resolved
+    style. Every distinct style is registered in the workbook once and shared by all cells that use it.
+    Cells named in the plan that fall outside the data are created afterwards, then the merges are applied.
+
+    Args:
+        worksheet (Worksheet): The worksheet to write to.
+        frame (pandas.DataFrame): The data to write, without its index or header.
+        plan (dict): The formatting plan, see ALLOC_FORMAT.
+
+    Returns:
+        None
+    """
+    resolve = compile_format_plan(plan)
+    titles = set(title for layer in plan['layers'] for title in layer.get('title_rows', []))
+    offset = plan.get('offset', 0)
+    letters = [get_column_letter(c) for c in range(1, len(frame.columns) + 1)]
+    styles = {}
+
+    def set_style(cell, style):
+        if style not in styles:
+            font, fill, number_format, alignment = style
+            if font is not None:
+                cell.font = font
+            if fill is not None:
+                cell.fill = fill
+            if number_format is not None:
+                cell.number_format = number_format
+            if alignment is not None:
+                cell.alignment = alignment
+            styles[style] = copy(cell._style)
+        else:
+            cell._style = copy(styles[style])
+
+    written = set()
+    for r_idx, row in enumerate(frame.itertuples(index=False), start=1):
+        is_title = any(value in titles for value in row if isinstance(value, str))
+        for c_idx, value in enumerate(row, start=1):
+            cell = worksheet.cell(row=r_idx + offset, column=c_idx, value=value)
+            set_style(cell, resolve(letters[c_idx - 1], r_idx, is_title))
+            written.add(cell.coordinate)
+    metrics.count(rows=len(frame), cells=frame.size)
+
+    for layer in plan['layers']:
+        for coord in layer.get('cells', []):
+            column = coord.rstrip('0123456789')
+            row = int(coord[len(column):])
+            cell = worksheet[f'{column}{row + offset}']
+            if cell.coordinate not in written:
+                set_style(cell, resolve(column, row, False))
+                written.add(cell.coordinate)
+
+    for column, width in plan.get('widths', {}).items():
+        worksheet.column_dimensions[column].width = width
+
+    for merged in plan.get('merges', []):
+        worksheet.merge_cells(merged)
+
+@metrics.instrument()
+def create_alloc_excel(alloc, session):
+    """
+    Writes the allocation data to the 'Allocations' sheet and apply specific formatting.
+
+    This function writes an allocation DataFrame to the session's workbook, creating or replacing the 'Allocations' sheet.
+    It applies the formatting in ALLOC_FORMAT, such as font, column width, number format, cell merging, and background
+    colors, to improve readability and organization of the data.
 
     Args:
         alloc (pandas.DataFrame): The DataFrame containing allocation data to be written to the Excel file.
-        file_name (str): The name of the Excel file where the data will be written. It should include the path and extension.
+        session (WorkbookSession): The session for the Excel file where the data will be written.
 
     Returns:
         None
@@ -311,96 +949,56 @@ def create_alloc_excel(alloc, file_name):
     try:
         sheet = 'Allocations'
         
-        if not os.path.exists(data_loc + file_name):
-            df.to_excel(data_loc + file_name, index=False, sheet_name=sheet)
-            
-        # Creates a Pandas Excel writer using XlsxWriter as the engine
-        writer = pd.ExcelWriter(data_loc + file_name, engine='openpyxl', mode='a', if_sheet_exists='replace')
-        
-        # Converts dataframe to an XlsxWriter Excel object
-        df.to_excel(writer, sheet_name=sheet, header=True)
-        
-        worksheet = writer.sheets[sheet]
-        
-        # Main Font for the spreadsheet
-        font_style = Font(name='Tahoma', size=10)
-        
-        # Iterate through all cells in the sheet and apply the font settings
-        for row in worksheet.iter_rows():
-            for cell in row:
-                cell.font = font_style
-        
-        # Formatting Column Width
-        worksheet.column_dimensions['A'].width = 30
-        worksheet.column_dimensions['B'].width = 30
-        worksheet.column_dimensions['C'].width = 30
-
-        # Populates sheet
-        for r_idx, row in enumerate(alloc.itertuples(), start=1):
-            for c_idx, value in enumerate(row[1:], start=1):
-                worksheet.cell(row=r_idx, column=c_idx, value=value)
-        
-        # Formatting numbers
-        for col in ['B', 'C']:
-            for cell in worksheet[col]:
-                cell.number_format = '0.00'
-        
-        # Making Title rows Gray, Bolded, and Centered
-        titles = ['North America', 'United Kingdom', 'Euroland (EU) Countries', 'Non-Euroland (EU) Countries',
-              'Far East & Australasia', 'Other', 'Latin America', 'Africa/Middle East', 'Eastern Europe',
-              'Far East ex-China', 'China', 'Other Emerging Markets', 'Emerging Market Total']
-        
-        gray_fill = PatternFill(start_color='D3D3D3', end_color='D3D3D3', fill_type='solid')
-        bold_font = Font(name='Tahoma', bold=True, size=10)
-        for row in worksheet.iter_rows(min_row=1, max_row=len(alloc), min_col=1, max_col=len(alloc.columns)):
-            for cell in row:
-                if cell.value in titles:
-                    for c in row:
-                        c.fill = gray_fill
-                        c.font = bold_font
-                        c.alignment = Alignment(horizontal='center', vertical='center')
-                    break  # Once the row is colored, no need to check further cells in the row
-        
-        # Making 2nd and 3rd columns always centered (text-align)
-        for col in ['B', 'C']:
-            for cell in worksheet[col]:
-                cell.alignment = Alignment(horizontal='center', vertical='center')
-        
-        # Formatting first specific columns
-        light_blue_fill = PatternFill(start_color='ADD8E6', end_color='ADD8E6', fill_type='solid')
-        for cell_ref in ['A1', 'A2', 'A3', 'A4', 'A5', 'A6']:
-            cell = worksheet[cell_ref]
-            cell.fill = light_blue_fill
-        
-        worksheet['A10'].font = bold_font
-        worksheet['A14'].font = bold_font
-        worksheet['A12'].alignment = Alignment(horizontal='center', vertical='center')
-        worksheet['A12'].font = Font(name='Tahoma', size=11, bold=True, color='00008B')
+        # Replaces any existing sheet, the allocations are populated below
+        worksheet = session.replace_sheet(sheet)
         
-        worksheet.insert_rows(1)  # To line it up with the template
-        
-        worksheet.merge_cells('A1:K1')
-        worksheet.merge_cells('A2:K2')
-        worksheet.merge_cells('A3:K3')
-        worksheet.merge_cells('A4:K4')
-        worksheet.merge_cells('A5:K5')
-        worksheet.merge_cells('A6:K6')
-        worksheet.merge_cells('A7:K7')
-        worksheet.merge_cells('A8:K8')
-        worksheet.merge_cells('A13:C13')
-        
-        writer.close()
+        # Populates and formats the sheet
+        apply_format_plan(worksheet, alloc, ALLOC_FORMAT)
 
-    except PermissionError:
-        print(f"Permission denied: The file {file_name} is open. Please close the file and try again.")
     except Exception as e:
+        metrics.record_error(e)
         print(f"An unexpected error occurred: {e}")
-        writer.close()
+        raise
+
+# Value-to-row lookups of each worksheet's looked up columns, kept until the worksheet is garbage collected
+_row_indexes = WeakKeyDictionary()
+
+def build_row_index(sheet, column):
+    """
+    Builds a value-to-row index for one column of an Excel sheet in a single pass.
+
+    Only the first row a value appears in is kept, matching the top-down search of get_row.
+    Each column is indexed on its first lookup and cached for the life of the sheet, so only the
+    looked up columns are ever indexed, and the index should only be used on sheets that are
+    read from, not written to.
+
+    Args:
+        sheet (Worksheet): The worksheet object to index.
+        column (str): The column letter to index.
+
+    Returns:
+        index (dict): A dictionary mapping each cell value in the column to its row number.
+    """
+    indexes = _row_indexes.setdefault(sheet, {})
+    if column in indexes:
+        return indexes[column]
+
+    col = column_index_from_string(column)
+    index = {}
+    for row, (value,) in enumerate(sheet.iter_rows(min_col=col, max_col=col, values_only=True), start=1):
+        if value is not None and value not in index:
+            index[value] = row
+
+    indexes[column] = index
+    return index
 
 def get_row(phrase, column, sheet):
     """
     Searches for a phrase in a specific column of an Excel sheet and returns the row number where it is found.
 
+    The search uses the column's cached row index (see build_row_index), so only the first lookup
+    in a column reads through its cells.
+
     Args:
         phrase (str): The phrase to search for.
         column (str): The column letter where the search is performed.
@@ -409,11 +1007,50 @@ def get_row(phrase, column, sheet):
     Returns:
         row (int): The row number where the phrase is found. Returns -1 if the phrase is not found.
     """
-    for row in range(1, sheet.max_row + 1):
-        cell_val = sheet[f'{column}{row}'].value
-        if cell_val == phrase:
-            return row
-    return -1
+    return build_row_index(sheet, column).get(phrase, -1)
+
+def get_chars_stats(chars, top_n=(10,), column='C'):
+    """
+    Computes the entry count, country count and top-N weight sums of the 'chars' worksheet in a single pass.
+
+    Entries are the non-empty cells in the given column from row 9. Countries are rows from row 9 with both
+    column 'B' (countries) and column 'D' (weights) non-empty, so countries with no securities are not counted.
+    The top-N sums add up the highest values in column 'D' from row 14 on rows where column 'B' is empty,
+    so only securities are included. The largest weights are kept in a heap bounded by the largest N.
+
+    Args:
+        chars (Worksheet): The worksheet object to compute the statistics from.
+        top_n (iterable of int): The sizes of the top-N sums to compute, e.g. (10, 20, 50).
+        column (str): The column letter to count entries in.
+
+    Returns:
+        stats (dict): A dictionary with the 'entries' count, the 'countries' count, and 'top_sums',
+        a dictionary where keys are the N values and values are the sums of the N highest weights.
+    """
+    top_n = sorted(set(top_n))
+    keep = top_n[-1] if top_n else 0
+    col_idx = column_index_from_string(column)
+    last_col = max(col_idx, 4)
+
+    entries = 0
+    countries = 0
+    heap = []
+    for row, values in enumerate(chars.iter_rows(min_row=9, max_col=last_col, values_only=True), start=9):
+        country, weight = values[1], values[3]
+        if values[col_idx - 1] is not None:
+            entries += 1
+        if country is not None:
+            if weight is not None:
+                countries += 1
+        elif weight is not None and row >= 14 and keep:
+            if len(heap) < keep:
+                heapq.heappush(heap, weight)
+            elif weight > heap[0]:
+                heapq.heapreplace(heap, weight)
+
+    largest = sorted(heap, reverse=True)
+    top_sums = {n: sum(largest[:n]) for n in top_n}
+    return {'entries': entries, 'countries': countries, 'top_sums': top_sums}
 
 def get_num_entries(column, sheet):
     """
@@ -426,12 +1063,7 @@ def get_num_entries(column, sheet):
     Returns:
         count (int): The number of non-empty entries in the specified column.
     """
-    count = 0
-    for row in range(9, sheet.max_row + 1):
-        cell_val = sheet[f'{column}{row}'].value
-        if cell_val is not None:
-            count += 1
-    return count
+    return get_chars_stats(sheet, top_n=(), column=column)['entries']
 
 def get_num_countries(chars):
     """
@@ -442,13 +1074,7 @@ def get_num_countries(chars):
     Returns:
         count (int): The count of entries meeting the criteria.
     """
-    count = 0
-    for row in range(9, chars.max_row + 1):
-        cell_val = chars[f'{"B"}{row}'].value
-        check = chars[f'{"D"}{row}'].value
-        if cell_val is not None and check is not None:
-            count += 1
-    return count
+    return get_chars_stats(chars, top_n=())['countries']
 
 def get_top_10_sum(chars):
     """
@@ -459,25 +1085,119 @@ def get_top_10_sum(chars):
     Returns:
         sum_top_10 (float): The sum of the top 10 highest values.
     """
-    values = []
-    for row in range(14, chars.max_row + 1):
-        cell_val = chars[f'{"D"}{row}'].value
-        ignore = chars[f'{"B"}{row}'].value
-        if cell_val is not None and ignore is None:
-            values.append(cell_val)
+    return get_chars_stats(chars, top_n=(10,))['top_sums'][10]
+
+class SheetValues:
+    """
+    Holds the cell values of a worksheet that was streamed in read-only mode.
+
+    Only the values of the requested columns are kept, one list per column, so none of the
+    cell or style objects of a normal workbook are built. It supports the parts of the Worksheet
+    interface the characteristics helpers use: `sheet['D12'].value`, `iter_rows` and `max_row`.
+
+    Args:
+        rows (list): The rows of values, each a tuple starting at column 'A'.
+        columns (iterable of str): The column letters to keep. Keeps every column if None.
+    """
+
+    class _Cell:
+        __slots__ = ('value',)
+
+        def __init__(self, value):
+            self.value = value
+
+    def __init__(self, rows, columns=None):
+        width = max((len(row) for row in rows), default=0)
+        if columns is None:
+            columns = [get_column_letter(i) for i in range(1, width + 1)]
+
+        self.max_row = len(rows)
+        self.max_column = max((column_index_from_string(c) for c in columns), default=0)
+        self.columns = {}
+        for column in columns:
+            i = column_index_from_string(column) - 1
+            self.columns[column] = [row[i] if i < len(row) else None for row in rows]
+
+    def __getitem__(self, coordinate):
+        column = coordinate.rstrip('0123456789')
+        row = int(coordinate[len(column):])
+        values = self.columns.get(column)
+        if values is None or not 1 <= row <= self.max_row:
+            return self._Cell(None)
+        return self._Cell(values[row - 1])
+
+    def iter_rows(self, min_row=1, max_row=None, min_col=1, max_col=None, values_only=True):
+        max_row = self.max_row if max_row is None else min(max_row, self.max_row)
+        max_col = self.max_column if max_col is None else max_col
+        empty = [None] * self.max_row
+        columns = [self.columns.get(get_column_letter(c), empty) for c in range(min_col, max_col + 1)]
+        for row in range(min_row - 1, max_row):
+            yield tuple(values[row] for values in columns)
+
+@metrics.instrument()
+def load_sheet_values(path, sheet_names, columns=None):
+    """
+    Streams sheets from an Excel workbook in read-only, values-only mode.
+
+    The workbook is read row by row and only the requested columns are kept (see SheetValues),
+    so peak memory stays far below that of a normal load_workbook.
+
+    Args:
+        path (str): The path to the Excel workbook.
+        sheet_names (list of str): The names of the sheets to read.
+        columns (dict): Optional mapping of sheet names to the column letters to keep from them.
+        Sheets that are not in the mapping keep every column.
+
+    Returns:
+        sheets (dict): A dictionary where keys are sheet names and values are SheetValues objects.
+    """
+    columns = columns or {}
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        sheets = {}
+        for name in sheet_names:
+            keep = columns.get(name)
+            max_col = max(column_index_from_string(c) for c in keep) if keep else None
+            rows = list(wb[name].iter_rows(max_col=max_col, values_only=True))
+            sheets[name] = SheetValues(rows, keep)
+            metrics.count(rows=len(rows))
+    finally:
+        wb.close()
+    return sheets
+
+def read_market_cap_weights(path, cash, buckets=None):
+    """
+    Reads the weights of the market cap buckets from the 'Holdings' sheet of a market caps workbook,
+    for holdings files without a market cap column (see get_market_cap_weights).
 
-    sorted_vals = sorted(values, reverse=True)
-    top_10 = sorted_vals[:10]
-    sum_top_10 = sum(top_10)
-    return sum_top_10
+    Args:
+        path (str): The path to the market caps workbook.
+        cash (float): The weight of cash in percent, which the bucket weights are adjusted for.
+        buckets (list of tuple): The buckets, largest first, as (label, lower edge) pairs. Defaults to the
+        'market_cap_buckets' setting.
 
-def create_chars_excel(wb, wb2):
+    Returns:
+        caps (dict): A dictionary where keys are the bucket labels, largest first, and values are their weighted percentages.
+    """
+    buckets = market_cap_buckets if buckets is None else buckets
+    if stream_sources:
+        holds = load_sheet_values(path, ['Holdings'], columns={'Holdings': ['B', 'D']})['Holdings']
+    else:
+        holds = load_workbook(path)['Holdings']
+
+    weight = 100 / (100 - cash)
+    return {label: holds['D' + str(get_row(label, 'B', holds))].value * weight for label, _ in buckets}
+
+@metrics.instrument()
+def create_chars_excel(wb, caps):
     """
     Updates the 'CharacteristicsUpdated' sheet (the formatted sheet) in the
-    workbook with various values from 'Characteristics' and 'Sectors' sheets.
+    workbook with various values from 'Characteristics' and 'Sectors' sheets, and the market cap buckets.
 
     Args:
         wb (Workbook): The openpyxl Workbook object containing the sheets.
+        caps (dict): The cash-adjusted weighted percentages of the market cap buckets, largest first,
+        see get_market_cap_weights.
 
     Returns:
         format (Worksheet): The updated 'CharacteristicsUpdated' sheet object.
@@ -486,11 +1206,13 @@ def create_chars_excel(wb, wb2):
     chars = wb['Characteristics']
     sectors = wb['Sectors']
     overall_row = get_row('##############################', 'A', chars)
+    cash_row = get_row('US Dollar Spot', 'C', chars)
+    stats = get_chars_stats(chars, top_n=(10,))
 
-    format['B17'] = chars['D' + str(get_row('US Dollar Spot', 'C', chars))].value / 100
-    format['B19'] = get_num_entries('C', chars)
-    format['B20'] = get_top_10_sum(chars) / 100
-    format['B21'] = get_num_countries(chars)
+    format['B17'] = chars['D' + str(cash_row)].value / 100
+    format['B19'] = stats['entries']
+    format['B20'] = stats['top_sums'][10] / 100
+    format['B21'] = stats['countries']
     format['B24'] = chars['AC' + str(overall_row)].value / 100
     format['B28'] = chars[f'{"U"}{overall_row}'].value / 100
     format['B29'] = chars[f'{"K"}{overall_row}'].value
@@ -504,7 +1226,7 @@ def create_chars_excel(wb, wb2):
     format['B41'] = chars[f'{"G"}{overall_row}'].value
     format['B42'] = chars[f'{"I"}{overall_row}'].value
     
-    format['B48'] = (100 - chars['D' + str(get_row('US Dollar Spot', 'C', chars))].value) / 100
+    format['B48'] = (100 - chars['D' + str(cash_row)].value) / 100
     format['B49'] = 0
     format['B50'] = 0
     format['B51'] = format['B17'].value
@@ -512,13 +1234,8 @@ def create_chars_excel(wb, wb2):
 
     format['B55'] = 0
     format['B56'] = 0
-    holds = wb2['Holdings']
-    weight = 1 / (1 - format['B51'].value)
-    format['B57'] = holds['D' + str(get_row('7.5-15B', 'B', holds))].value * weight / 100
-    format['B58'] = holds['D' + str(get_row('1.5-7.5B', 'B', holds))].value * weight / 100
-    format['B59'] = holds['D' + str(get_row('750M-1.5B', 'B', holds))].value * weight / 100
-    format['B60'] = holds['D' + str(get_row('400-750M', 'B', holds))].value * weight / 100
-    format['B61'] = holds['D' + str(get_row('<400M', 'B', holds))].value * weight / 100
+    for i, value in enumerate(caps.values()):
+        format['B' + str(57 + i)] = value / 100
     
     format['B64'] = sectors['E' + str(get_row('Communication Services', 'B', sectors))].value
     format['B65'] = sectors['E' + str(get_row('Consumer Discretionary', 'B', sectors))].value
@@ -557,11 +1274,13 @@ def create_chars_excel(wb, wb2):
 
     return format
 
+@metrics.instrument()
 def copy_sheet_attributes(source_sheet, target_sheet):
     """
     Copies various attributes from a source worksheet to a target worksheet. 
-    Specifically, these are the sheet format, properties, merged cells, page margins, freeze panes, row dimensions,
-    specific column widths, and hidden properties settings from the source sheet.
+    Specifically, these are the sheet format, properties, page margins, freeze panes, row dimensions,
+    specific column widths, and hidden properties settings from the source sheet. Merged cells are
+    copied by copy_cells.
 
     Parameters:
     - source_sheet (Worksheet): The source worksheet from which attributes are copied.
@@ -572,13 +1291,17 @@ def copy_sheet_attributes(source_sheet, target_sheet):
     """
     target_sheet.sheet_format = copy(source_sheet.sheet_format)
     target_sheet.sheet_properties = copy(source_sheet.sheet_properties)
-    target_sheet.merged_cells = copy(source_sheet.merged_cells)
     target_sheet.page_margins = copy(source_sheet.page_margins)
     target_sheet.freeze_panes = copy(source_sheet.freeze_panes)
 
-    # set row dimensions
-    for rn in range(len(source_sheet.row_dimensions)):
-        target_sheet.row_dimensions[rn] = copy(source_sheet.row_dimensions[rn])
+    # set row dimensions, only for the rows the source sheet actually has settings for
+    for rn, dim in source_sheet.row_dimensions.items():
+        if dim.ht is None and not dim.hidden and not dim.outlineLevel:
+            continue
+        target_dim = target_sheet.row_dimensions[rn]
+        target_dim.ht = dim.ht
+        target_dim.hidden = dim.hidden
+        target_dim.outlineLevel = dim.outlineLevel
 
     if source_sheet.sheet_format.defaultColWidth is not None:
         target_sheet.sheet_format.defaultColWidth = copy(source_sheet.sheet_format.defaultColWidth)
@@ -590,11 +1313,42 @@ def copy_sheet_attributes(source_sheet, target_sheet):
         target_sheet.column_dimensions[key].width = copy(source_sheet.column_dimensions[key].width)
         target_sheet.column_dimensions[key].hidden = copy(source_sheet.column_dimensions[key].hidden)
 
+def intern_style(source_cell, target_cell, styles):
+    """
+    Gives a target cell the same style as a source cell, registering each distinct style only once.
+
+    The first cell with a given style has its font, border, fill, number format, protection and alignment
+    copied into the target workbook's shared style tables. Every later cell with the same style reuses the
+    registered style directly, so no style objects are created for it.
+
+    Parameters:
+    - source_cell (Cell): The cell whose style is copied.
+    - target_cell (Cell): The cell the style is copied to.
+    - styles (dict): The styles registered so far, keyed by the source cell's style ids.
+
+    Returns:
+    - None
+    """
+    key = tuple(source_cell._style)
+    if key not in styles:
+        target_cell.font = copy(source_cell.font)
+        target_cell.border = copy(source_cell.border)
+        target_cell.fill = copy(source_cell.fill)
+        target_cell.number_format = copy(source_cell.number_format)
+        target_cell.protection = copy(source_cell.protection)
+        target_cell.alignment = copy(source_cell.alignment)
+        styles[key] = copy(target_cell._style)
+    else:
+        target_cell._style = copy(styles[key])
+
+@metrics.instrument()
 def copy_cells(source_sheet, target_sheet):
     """
-    Copies cell values, styles, hyperlinks, and comments from a source worksheet to a target worksheet,
-    excluding cells listed in the 'forbidden' list. The 'forbidden' list contains merged cells that are
-    read-only and will throw an error if you try reassigning them.
+    Copies cell values, styles, hyperlinks, comments and merged cells from a source worksheet to a target worksheet.
+
+    Merged ranges already on the target sheet are unmerged first, since the cells inside them are read-only,
+    and the source sheet's merged ranges are merged again once the values are in. Identical styles are only
+    registered once in the target workbook (see intern_style).
 
     Parameters:
     - source_sheet (Worksheet): The worksheet from which cells are copied.
@@ -603,27 +1357,29 @@ def copy_cells(source_sheet, target_sheet):
     Returns:
     - None
     """
-    forbidden = ['G12', 'H12', 'F13', 'B14', 'C14', 'D14', 'E14', 'B63', 'B77']
+    for merged in list(target_sheet.merged_cells.ranges):
+        target_sheet.unmerge_cells(merged.coord)
+
+    styles = {}
+    merged_cells = []
     for row in source_sheet.iter_rows():
         for source_cell in row:
-            
-            if source_cell.coordinate in forbidden:
-                continue # Skip cells listed in forbidden
+
+            # Cells inside a merged range have no value, only their borders are copied after merging
+            if isinstance(source_cell, MergedCell):
+                if source_cell.has_style:
+                    merged_cells.append(source_cell)
+                continue
 
             # Get corresponding cell in target sheet
-            target_cell = target_sheet.cell(row=source_cell.row, column=source_cell.col_idx)
+            target_cell = target_sheet.cell(row=source_cell.row, column=source_cell.column)
 
             # Copy value
             target_cell.value = source_cell.value
 
             # Copy style if present
             if source_cell.has_style:
-                target_cell.font = copy(source_cell.font)
-                target_cell.border = copy(source_cell.border)
-                target_cell.fill = copy(source_cell.fill)
-                target_cell.number_format = copy(source_cell.number_format)
-                target_cell.protection = copy(source_cell.protection)
-                target_cell.alignment = copy(source_cell.alignment)
+                intern_style(source_cell, target_cell, styles)
 
             # Copy hyperlink if present
             if source_cell.hyperlink:
@@ -633,26 +1389,27 @@ def copy_cells(source_sheet, target_sheet):
             if source_cell.comment:
                 target_cell.comment = copy(source_cell.comment)
 
-def copy_chars_sheet_to_main(sheet, file_name):
+    metrics.count(rows=source_sheet.max_row, cells=len(source_sheet._cells) - len(merged_cells))
+
+    for merged in source_sheet.merged_cells.ranges:
+        target_sheet.merge_cells(merged.coord)
+
+    for source_cell in merged_cells:
+        intern_style(source_cell, target_sheet._cells[(source_cell.row, source_cell.column)], styles)
+
+def copy_chars_sheet_to_main(sheet, session):
     """
     Copy a sheet to another workbook, ensuring the target workbook has a sheet named 'Characteristics'.
 
     Args:
         sheet (Worksheet): The openpyxl Worksheet object to copy.
-        file_name (str): The name of the target Excel file.
+        session (WorkbookSession): The session for the target Excel file.
 
     Returns:
         None
     """
     sheet_name = 'Characteristics'
-    
-    if not os.path.exists(data_loc + file_name):
-        target = Workbook()
-        sheet = workbook.active
-        sheet.title = sheet_name
-        workbook.save(data_loc + file_name)
-    else:
-        target = load_workbook(data_loc + file_name)
+    target = session.book
 
     if sheet_name in target.sheetnames:
         # Get the specific sheet if it exists
@@ -663,59 +1420,485 @@ def copy_chars_sheet_to_main(sheet, file_name):
     
     copy_cells(sheet, target_sheet)  # copy all the cell values and styles
     copy_sheet_attributes(sheet, target_sheet)
-    
-    target.save(data_loc + file_name)
 
 
-# In[4]:
+def portfolio_path(portfolio, key):
+    """
+    Gets the full path of one of a portfolio's files.
 
+    Args:
+        portfolio (dict): The portfolio's input and output files (see the 'portfolio' setting).
+        key (str): The file to get, e.g. 'holdings' or 'performance'.
 
-# Holdings
-holds = pd.read_excel(data_loc + "##############################", skiprows=10)
-df = pd.DataFrame(columns = ['Identifier', 'Identifier Type', 'Ticker', 'Security Name', 'Security Type',
-                             '# of Shares', 'Security Price', 'Weight (%)', 'Country', 'Market Value'])
+    Returns:
+        path (str): The path of the file. For 'performance' this is the file for the last day of the previous month.
+    """
+    if key == 'performance':
+        return data_loc + portfolio['performance'] + EOPM().strftime("%Y-%m-%d") + '.xlsx'
+    return data_loc + portfolio[key]
 
-df = get_securities(holds, df)
-insert_cash_row(df)
-create_holds_excel(df, "##############################")
+def save_snapshot(portfolio, kind, frame):
+    """
+    Adds a frame of a portfolio's run to the snapshot store (see the 'snapshot_dir' setting), dated with the
+    last day of the previous month. A snapshot that can't be saved is reported without failing the run.
 
+    Args:
+        portfolio (dict): The portfolio's input and output files (see the 'portfolio' setting).
+        kind (str): The kind of frame, e.g. 'holdings'.
+        frame (pandas.DataFrame): The frame to save.
 
-# In[5]:
+    Returns:
+        None
+    """
+    if snapshot_dir is None:
+        return
+    try:
+        snapshot_store.save_snapshot(snapshot_dir, kind, frame, EOPM(), portfolio['name'])
+    except Exception as e:
+        metrics.record_error(e)
+        print(f"Could not save the {kind} snapshot of {portfolio['name']}: {e}")
+
+def run_holdings_stage(portfolio, session):
+    """
+    Extracts the securities from the portfolio's holdings file, writes them to the 'Holdings' sheet and
+    adds them to the snapshot store.
+
+    Args:
+        portfolio (dict): The portfolio's input and output files (see the 'portfolio' setting).
+        session (WorkbookSession): The session for the portfolio's output file.
+
+    Returns:
+        holds (pandas.DataFrame): The holdings file as read, which the allocations stage also uses.
+    """
+    holds = read_excel_cached(portfolio_path(portfolio, 'holdings'), skiprows=10)
+    df = pd.DataFrame(columns=HOLDINGS_COLUMNS)
+
+    df = get_securities(holds, df)
+    df = insert_cash_row(df)
+    create_holds_excel(df, session)
+    save_snapshot(portfolio, 'holdings', df)
+    return holds
+
+def run_performance_stage(portfolio, session):
+    """
+    Extracts the strategies' performance for the end of the previous month, writes it to the 'Performance' sheet
+    and adds it to the snapshot store.
+
+    Args:
+        portfolio (dict): The portfolio's input and output files (see the 'portfolio' setting).
+        session (WorkbookSession): The session for the portfolio's output file.
+
+    Returns:
+        None
+    """
+    perf = read_excel_cached(portfolio_path(portfolio, 'performance'))
+    perf.drop(inplace=True, columns=['Unnamed: 0'])
+    df = pd.DataFrame(columns=['Gross', 'Net', 'Strategy', 'Date'])
+
+    df = extract_perf_info(perf, df)
+    create_perf_excel(df, session)
+    save_snapshot(portfolio, 'performance', df)
+
+def run_allocations_stage(portfolio, session, holds=None):
+    """
+    Fills in the country weights of the portfolio's allocations file, writes it to the 'Allocations' sheet and
+    adds it to the snapshot store.
+
+    Args:
+        portfolio (dict): The portfolio's input and output files (see the 'portfolio' setting).
+        session (WorkbookSession): The session for the portfolio's output file.
+        holds (pandas.DataFrame): The holdings file as returned by run_holdings_stage. It is read again if None,
+        which happens when the holdings stage was skipped.
+
+    Returns:
+        None
+    """
+    if holds is None:
+        holds = read_excel_cached(portfolio_path(portfolio, 'holdings'), skiprows=10)
+    countries = get_countries_weighted(holds)
+
+    alloc = read_excel_cached(portfolio_path(portfolio, 'allocations'))
+    alloc.columns = ['Market', 'Country (%)', 'Currency (%)']
+
+    alloc = update_alloc(countries, alloc)
+    create_alloc_excel(alloc, session)
+    save_snapshot(portfolio, 'allocations', alloc)
+
+def reads_market_caps(portfolio):
+    """
+    Checks whether the characteristics stage reads the portfolio's market_caps file, which it only does when
+    the holdings file has no 'market_cap_column'.
+
+    Args:
+        portfolio (dict): The portfolio's input and output files (see the 'portfolio' setting).
 
+    Returns:
+        reads (bool): Whether the market_caps file is read.
+    """
+    holds = read_excel_cached(portfolio_path(portfolio, 'holdings'), skiprows=10)
+    return market_cap_column not in holds.columns
 
-# Performance
-perf = pd.read_excel(data_loc + "##############################" + EOPM().strftime("%Y-%m-%d") + '.xlsx')
-perf.drop(inplace=True, columns=['Unnamed: 0'])
-df = pd.DataFrame(columns=['Gross', 'Net', 'Strategy', 'Date'])
+def run_characteristics_stage(portfolio, session):
+    """
+    Fills in the portfolio's formatted characteristics sheet and copies it to the 'Characteristics' sheet.
 
+    Args:
+        portfolio (dict): The portfolio's input and output files (see the 'portfolio' setting).
+        session (WorkbookSession): The session for the portfolio's output file.
+
+    Returns:
+        None
+    """
+    start = time.perf_counter()
+    wb = load_workbook(portfolio_path(portfolio, 'characteristics'))
+    holds = read_excel_cached(portfolio_path(portfolio, 'holdings'), skiprows=10)
+    if market_cap_column in holds.columns:
+        caps = get_market_cap_weights(holds)
+    else:
+        print(f"No '{market_cap_column}' column in {portfolio['holdings']}, reading the market caps from {portfolio['market_caps']}")
+        chars = wb['Characteristics']
+        caps = read_market_cap_weights(portfolio_path(portfolio, 'market_caps'),
+                                       chars['D' + str(get_row('US Dollar Spot', 'C', chars))].value)
+    print(f"Loaded the characteristics and market cap weights in {time.perf_counter() - start:.2f}s "
+          f"({'streamed' if stream_sources else 'full'})")
+    format = create_chars_excel(wb, caps)
+    copy_chars_sheet_to_main(format, session)
+
+# The stages of a portfolio's run, as a dependency graph. Each stage lists the portfolio files it reads
+# ('inputs', or a function of the portfolio giving them), the sheets it writes ('sheets'), the stages whose
+# results it uses ('after') and the functions whose code its output depends on ('code'), plus any other
+# setting its output depends on ('extra').
+PERF_STAGES = {
+    'holdings': {
+        'run': lambda portfolio, session, results: run_holdings_stage(portfolio, session),
+        'inputs': ['holdings'],
+        'sheets': ['Holdings'],
+        'after': [],
+        'code': ['run_holdings_stage', 'get_securities', 'apply_holdings_schema', 'insert_cash_row', 'create_holds_excel'],
+        'extra': lambda: repr(HOLDINGS_SCHEMA),
+    },
+    'performance': {
+        'run': lambda portfolio, session, results: run_performance_stage(portfolio, session),
+        'inputs': ['performance'],
+        'sheets': ['Performance'],
+        'after': [],
+        'code': ['run_performance_stage', 'extract_perf_info', 'create_perf_excel'],
+        'extra': lambda: date.today().isoformat(),  # The sheet is dated with the day it is made
+    },
+    'allocations': {
+        'run': lambda portfolio, session, results: run_allocations_stage(portfolio, session, results.get('holdings')),
+        'inputs': ['holdings', 'allocations'],
+        'sheets': ['Allocations'],
+        'after': ['holdings'],
+        'code': ['run_allocations_stage', 'get_countries_weighted', 'get_securities', 'apply_holdings_schema',
+                 'get_weights', 'cash_mask', 'update_alloc', 'match_countries', 'CountryMatcher', 'create_alloc_excel',
+                 'apply_format_plan', 'compile_format_plan'],
+        'extra': lambda: repr(ALLOC_FORMAT['layers']) + repr(ALLOC_FORMAT['merges']),
+    },
+    'characteristics': {
+        'run': lambda portfolio, session, results: run_characteristics_stage(portfolio, session),
+        # The market_caps file only when the holdings file has no market caps
+        'inputs': lambda portfolio: ['characteristics', 'holdings'] + (['market_caps'] if reads_market_caps(portfolio) else []),
+        'sheets': ['Characteristics'],
+        'after': [],
+        'code': ['run_characteristics_stage', 'create_chars_excel', 'get_chars_stats', 'get_row', 'build_row_index',
+                 'get_market_cap_weights', 'read_market_cap_weights', 'get_weights', 'cash_mask', 'get_securities',
+                 'apply_holdings_schema', 'load_sheet_values', 'SheetValues', 'copy_chars_sheet_to_main', 'copy_cells',
+                 'intern_style', 'copy_sheet_attributes'],
+        'extra': lambda: str(stream_sources) + market_cap_column + repr(market_cap_buckets) + repr(market_cap_upper),
+    },
+}
+
+def stage_order(stages, names=None):
+    """
+    Orders the stages of a dependency graph so every stage comes after the stages it uses.
 
-df = extract_perf_info(perf, df)
-create_perf_excel(df, "##############################")
+    Args:
+        stages (dict): The stages, see PERF_STAGES.
+        names (list of str): Only order these stages and the stages they use, directly or not. Defaults to every stage.
 
+    Returns:
+        order (list of str): The names of the stages in the order they should run.
+    """
+    order = []
+    visiting = set()
+
+    def visit(name):
+        if name in order:
+            return
+        if name in visiting:
+            raise ValueError(f"Stage {name} depends on itself")
+        visiting.add(name)
+        for upstream in stages[name]['after']:
+            visit(upstream)
+        visiting.discard(name)
+        order.append(name)
+
+    for name in stages if names is None else names:
+        visit(name)
+    return order
+
+def stage_dependents(stages, name):
+    """
+    Finds a stage and the stages that use it, directly or not.
 
-# In[6]:
+    Args:
+        stages (dict): The stages, see PERF_STAGES.
+        name (str): The name of the stage.
 
+    Returns:
+        dependents (set of str): The names of the stage and of every stage downstream of it.
+    """
+    dependents = {name}
+    for other in stage_order(stages):
+        if any(upstream in dependents for upstream in stages[other]['after']):
+            dependents.add(other)
+    return dependents
 
-# Allocations
-countries = get_countries_weighted(holds)
+def code_source(obj):
+    """
+    Gets the source code of a function or class, for fingerprinting.
 
-alloc = pd.read_excel(data_loc + '##############################')
-alloc.columns = ['Market', 'Country (%)', 'Currency (%)']
+    Classes defined in a notebook have no source file, so their methods' source is used instead.
 
-alloc = update_alloc(countries, alloc)
-create_alloc_excel(alloc, "##############################")
+    Args:
+        obj (function or class): The function or class.
 
+    Returns:
+        source (str): The source code.
+    """
+    try:
+        return inspect.getsource(obj)
+    except (OSError, TypeError):
+        return ''.join(code_source(member) for member in vars(obj).values() if inspect.isfunction(member))
+
+def stage_fingerprint(portfolio, name, stages, fingerprints):
+    """
+    Fingerprints a stage from the contents of its input files, the code of its functions, its extra settings
+    and the fingerprints of the stages it uses, so it changes whenever the stage's output could change.
+
+    Args:
+        portfolio (dict): The portfolio's input and output files (see the 'portfolio' setting).
+        name (str): The name of the stage.
+        stages (dict): The stages, see PERF_STAGES.
+        fingerprints (dict): The fingerprints of the stages earlier in the order.
+
+    Returns:
+        fingerprint (str): The SHA-256 hex digest of the stage.
+    """
+    stage = stages[name]
+    digest = hashlib.sha256(name.encode())
+    inputs = stage['inputs'](portfolio) if callable(stage['inputs']) else stage['inputs']
+    for key in inputs:
+        digest.update(f"{key}={file_hash(portfolio_path(portfolio, key))}".encode())
+    for function in stage['code']:
+        digest.update(code_source(globals()[function]).encode())
+    if 'extra' in stage:
+        digest.update(stage['extra']().encode())
+    for upstream in stage['after']:
+        digest.update(fingerprints[upstream].encode())
+    return digest.hexdigest()
+
+def load_fingerprints(portfolio):
+    """
+    Reads the stage fingerprints recorded by the last run of a portfolio.
+
+    Args:
+        portfolio (dict): The portfolio's input and output files (see the 'portfolio' setting).
+
+    Returns:
+        fingerprints (dict): A dictionary where keys are stage names and values are their fingerprints.
+        Empty if the portfolio hasn't been run yet.
+    """
+    try:
+        with open(data_loc + portfolio['output'] + '.stages.json') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_fingerprints(portfolio, fingerprints):
+    """
+    Records the stage fingerprints of a portfolio's run next to its output file.
+
+    Args:
+        portfolio (dict): The portfolio's input and output files (see the 'portfolio' setting).
+        fingerprints (dict): A dictionary where keys are stage names and values are their fingerprints.
 
-# In[7]:
+    Returns:
+        None
+    """
+    with open(data_loc + portfolio['output'] + '.stages.json', 'w') as f:
+        json.dump(fingerprints, f, indent=2)
+
+def run_portfolio(portfolio, rerun=None, stages=None):
+    """
+    Runs the stages of PERF_STAGES for one portfolio and saves its output file.
+
+    A stage is skipped when its fingerprint (see stage_fingerprint) matches the one recorded by the last
+    run and its sheets are still in the output file, so a rerun after correcting one input file only
+    redoes the stages reading it. A failing stage stops the portfolio's run, but whatever was written
+    before it is still saved. The failing stage, the stages after it and the stages using them lose their
+    recorded fingerprints, so the next run redoes them. The output file is only loaded when a stage has to run.
+
+    Args:
+        portfolio (dict): The portfolio's input and output files (see the 'portfolio' setting).
+        rerun (bool): Whether to rerun every stage regardless of its fingerprint. Defaults to the 'rerun_all' setting.
+        stages (list of str): Only run these stages, leaving the others' sheets as they are. Defaults to every stage.
+
+    Returns:
+        result (dict): The portfolio's 'name', its 'status' ('ok' or 'failed'), the 'error' if it failed,
+        the 'timings' in seconds of each stage that ran and the names of the 'skipped' stages.
+    """
+    rerun = rerun_all if rerun is None else rerun
+    result = {'name': portfolio['name'], 'status': 'ok', 'error': None, 'timings': {}, 'skipped': []}
+
+    def timed(name, stage, *args):
+        start = time.perf_counter()
+        try:
+            with metrics.measure(name, portfolio=portfolio['name']):
+                return stage(*args)
+        finally:
+            result['timings'][name] = time.perf_counter() - start
+
+    previous = load_fingerprints(portfolio)
+    recorded = dict(previous)
+    fingerprints = {}
+    planned = []
+    done = []
+    session = None
+    with metrics.measure('run_portfolio', portfolio=portfolio['name']) as record:
+        try:
+            existing = sheet_names(portfolio['output'])
+            # The stages that aren't run are only fingerprinted when a stage that is run uses them
+            for name in stage_order(PERF_STAGES, stages):
+                stage = PERF_STAGES[name]
+                fingerprints[name] = stage_fingerprint(portfolio, name, PERF_STAGES, fingerprints)
+                if stages is not None and name not in stages:
+                    continue
+                if (not rerun and previous.get(name) == fingerprints[name]
+                        and all(sheet in existing for sheet in stage['sheets'])):
+                    result['skipped'].append(name)
+                    continue
+                planned.append(name)
+
+            # The output file is only loaded if a stage has to run, without the sheets the stages replace
+            if planned:
+                session = timed('open', WorkbookSession, portfolio['output'],
+                                [sheet for name in planned for sheet in PERF_STAGES[name]['sheets']])
+            results = {}
+            for name in planned:
+                results[name] = timed(name, PERF_STAGES[name]['run'], portfolio, session, results)
+                done.append(name)
+
+        except Exception as e:
+            metrics.record_error(e)
+            result['status'] = 'failed'
+            result['error'] = f"{type(e).__name__}: {e}"
+
+        finally:
+            if session is not None and done and timed('save', session.save):
+                recorded.update({name: fingerprints[name] for name in done})
+                # The stages that didn't finish may have left their sheets empty or half written, so they and
+                # the stages using them rerun next time
+                for name in planned:
+                    if name not in done:
+                        for dependent in stage_dependents(PERF_STAGES, name):
+                            recorded.pop(dependent, None)
+                save_fingerprints(portfolio, recorded)
+            record['skipped'] = result['skipped']
+
+    return result
+
+def print_result(result):
+    """
+    Prints a portfolio's status, the time each of its stages took and the stages that were skipped.
+
+    Args:
+        result (dict): The portfolio's result, see run_portfolio.
+
+    Returns:
+        None
+    """
+    parts = [f"{stage} {seconds:.2f}s" for stage, seconds in result['timings'].items()]
+    if result.get('skipped'):
+        parts.append(f"skipped {', '.join(result['skipped'])}")
+    print(f"{result['name']}: {result['status']} ({', '.join(parts)})" + (f" - {result['error']}" if result['error'] else ""))
+
+def load_manifest(path):
+    """
+    Reads a JSON manifest of portfolios, a list of dictionaries like the 'portfolio' setting.
+
+    Args:
+        path (str): The path to the manifest file.
+
+    Returns:
+        portfolios (list of dict): The portfolios in the manifest.
+    """
+    with open(path) as f:
+        portfolios = json.load(f)
+
+    for portfolio in portfolios:
+        missing = [key for key in ('name', 'output', 'holdings', 'performance', 'allocations',
+                                   'characteristics', 'market_caps') if key not in portfolio]
+        if missing:
+            raise ValueError(f"Portfolio {portfolio.get('name', '?')} in {path} is missing {', '.join(missing)}")
+    return portfolios
+
+def run_batch(portfolios, workers=None, rerun=None, stages=None):
+    """
+    Runs every portfolio's stages (see run_portfolio) in a pool of processes, one portfolio per process.
+
+    Each portfolio's status and timings are printed as it finishes. The portfolios must write to different
+    output files, since each process saves its own output workbook.
+
+    Args:
+        portfolios (list of dict): The portfolios to run, e.g. from load_manifest.
+        workers (int): The number of processes to use. Defaults to the number of cores.
+        rerun (bool): Whether to rerun every stage regardless of its fingerprint. Defaults to the 'rerun_all' setting.
+        stages (list of str): Only run these stages. Defaults to every stage.
+
+    Returns:
+        results (list of dict): The result of each portfolio (see run_portfolio), in the order they were given.
+    """
+    outputs = [portfolio['output'] for portfolio in portfolios]
+    if len(set(outputs)) != len(outputs):
+        raise ValueError("Each portfolio in a batch needs its own output file")
+
+    start = time.perf_counter()
+    results = [None] * len(portfolios)
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        futures = {pool.submit(run_portfolio, portfolio, rerun, stages): i for i, portfolio in enumerate(portfolios)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                metrics.emit({'name': 'run_portfolio', 'portfolio': portfolios[i]['name'], 'status': 'error',
+                              'error': f"{type(e).__name__}: {e}", 'pid': os.getpid()})
+                result = {'name': portfolios[i]['name'], 'status': 'failed',
+                          'error': f"{type(e).__name__}: {e}", 'timings': {}, 'skipped': []}
+            results[i] = result
+            print_result(result)
+
+    failed = sum(result['status'] != 'ok' for result in results)
+    print(f"Ran {len(portfolios)} portfolios in {time.perf_counter() - start:.2f}s, {failed} failed")
+    return results
+
+
+# In[4]:
+
+
+# Runs the holdings, performance, allocations and characteristics stages (see PERF_STAGES) that are out of date,
+# writing them to the output workbook and saving it once at the end
+# (only when this file is the main program, so batch worker processes don't rerun it)
+if __name__ == '__main__' and batch_manifest is None:
+    result = run_portfolio(portfolio)
+    print_result(result)
+
+
+# In[5]:
 
 
-# Characteristics
-try:
-    wb = load_workbook(data_loc + '##############################')
-    wb2 = load_workbook(data_loc + '##############################')
-    format = create_chars_excel(wb, wb2)
-    copy_chars_sheet_to_main(format, "##############################")
-except PermissionError:
-    print(f"Permission denied: The file {'##############################'} is open. Please close the file and try again.")
-except Exception as e:
-    print(f"An unexpected error occurred: {e}")
+# Batch of portfolios
+if __name__ == '__main__' and batch_manifest is not None:
+    results = run_batch(load_manifest(batch_manifest))
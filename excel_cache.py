@@ -0,0 +1,138 @@
+"""
+Cache of parsed Excel files, shared by evest-to-perf-sheet and generate-excel.
+
+Parsing an .xlsx file with pandas goes through openpyxl and is by far the slowest part of reading it,
+even though most of the input files don't change between reruns. read_excel_cached keys each parsed
+DataFrame on a hash of the file's contents plus the read parameters and keeps it as a pickle, so a
+rerun on an unchanged file skips the Excel parsing entirely.
+"""
+
+# For DataFrames
+import pandas as pd
+
+# For keying and storing the cache
+import hashlib
+import os
+
+# For recording how long each read takes
+import metrics
+
+
+# Largest total size of the cache directory before the least recently used entries are removed
+MAX_CACHE_BYTES = 512 * 1024 * 1024
+
+# Name of the cache directory, created next to the file being read unless another directory is given
+CACHE_DIR_NAME = '.excel-cache'
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    """
+    Hashes the contents of a file.
+
+    Args:
+        path (str): The path to the file.
+        chunk_size (int): The number of bytes read at a time.
+
+    Returns:
+        digest (str): The SHA-256 hex digest of the file's contents.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(path, **kwargs):
+    """
+    Builds the cache key of a file read with specific parameters.
+
+    The key changes whenever the file's contents, the read parameters or the pandas version change,
+    so a stale entry is never returned.
+
+    Args:
+        path (str): The path to the Excel file.
+        **kwargs: The keyword arguments passed to pandas.read_excel.
+
+    Returns:
+        key (str): The cache key, usable as a file name.
+    """
+    params = repr(sorted(kwargs.items()))
+    digest = hashlib.sha256(f'{file_hash(path)}|{params}|{pd.__version__}'.encode())
+    return digest.hexdigest()
+
+
+def evict(cache_dir, max_bytes=MAX_CACHE_BYTES):
+    """
+    Removes the least recently used entries of a cache directory until it fits in the size limit.
+
+    Args:
+        cache_dir (str): The cache directory.
+        max_bytes (int): The largest total size of the entries to keep.
+
+    Returns:
+        None
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.pkl'):
+            stat = os.stat(os.path.join(cache_dir, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+            total -= size
+        except FileNotFoundError:
+            pass
+
+
+def read_excel_cached(path, cache_dir=None, max_bytes=MAX_CACHE_BYTES, **kwargs):
+    """
+    Reads an Excel file into a DataFrame like pandas.read_excel, reusing the parsed DataFrame if the file hasn't changed.
+
+    Entries are stored as pickles named after their cache key (see cache_key). A hit marks the entry as
+    recently used, and every new entry evicts the least recently used ones once the cache is larger than
+    max_bytes. If the cache can't be written the DataFrame is still returned.
+
+    Args:
+        path (str): The path to the Excel file.
+        cache_dir (str): The cache directory. Defaults to a '.excel-cache' directory next to the file.
+        max_bytes (int): The largest total size of the cache directory.
+        **kwargs: The keyword arguments passed to pandas.read_excel, e.g. skiprows or usecols.
+
+    Returns:
+        df (pandas.DataFrame): The contents of the Excel file.
+    """
+    with metrics.measure('read_excel', path=path, **kwargs) as record:
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(os.path.abspath(path)), CACHE_DIR_NAME)
+        entry = os.path.join(cache_dir, cache_key(path, **kwargs) + '.pkl')
+
+        if os.path.exists(entry):
+            try:
+                df = pd.read_pickle(entry)
+                os.utime(entry)
+                record['cache'] = 'hit'
+                metrics.count(rows=len(df))
+                return df
+            except Exception:
+                pass  # A damaged entry is parsed again and replaced below
+
+        df = pd.read_excel(path, **kwargs)
+        record['cache'] = 'miss'
+        metrics.count(rows=len(df))
+
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            df.to_pickle(entry + '.tmp')
+            os.replace(entry + '.tmp', entry)
+            evict(cache_dir, max_bytes)
+        except OSError as e:
+            metrics.record_error(e)
+            print(f"Could not cache {path}: {e}")
+
+        return df
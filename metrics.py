@@ -0,0 +1,216 @@
+"""
+Per-stage metrics for evest-to-perf-sheet and generate-excel, emitted as JSON lines.
+
+Each measured block (see measure and instrument) records its wall time, CPU time, the process' peak RSS,
+the rows it processed and cells it wrote, and whether it failed, and appends them as one JSON object per
+line to the metrics file. Errors that a block catches and only prints can be attached to it with
+record_error, so they still show up in the metrics. An opt-in profiling mode runs the outermost blocks
+under cProfile, or tracks their peak Python memory with tracemalloc.
+"""
+
+# For measuring
+import cProfile
+import functools
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+# Peak RSS comes from getrusage, which Windows doesn't have
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# Where the metrics are written, None to only measure without writing anything
+_path = None
+
+# None, 'cprofile' or 'tracemalloc'
+_profile = None
+
+# The blocks being measured, innermost last
+_stack = []
+
+
+def configure(path=None, profile=None):
+    """
+    Sets where the metrics are written and the profiling mode.
+
+    Args:
+        path (str): The JSON lines file the metrics are appended to. Nothing is written if None.
+        profile (str): None, 'cprofile' to profile the outermost blocks (saved next to the metrics file as
+        <metrics file>.<block>.<pid>.prof), or 'tracemalloc' to record each block's peak traced memory.
+
+    Returns:
+        None
+    """
+    global _path, _profile
+    if profile not in (None, 'cprofile', 'tracemalloc'):
+        raise ValueError(f"Unknown profiling mode {profile}, use None, 'cprofile' or 'tracemalloc'")
+    _path = path
+    _profile = profile
+    if profile == 'tracemalloc' and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def peak_rss_mb():
+    """
+    Gets the peak resident memory of the process so far.
+
+    Returns:
+        peak (float): The peak RSS in MB, or None where it can't be read.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10  # bytes on macOS, KB elsewhere
+
+
+def emit(record):
+    """
+    Appends a record to the metrics file as one JSON line.
+
+    Args:
+        record (dict): The record.
+
+    Returns:
+        None
+    """
+    if _path is None:
+        return
+    try:
+        with open(_path, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+    except OSError as e:
+        print(f"Could not write metrics to {_path}: {e}")
+
+
+def current():
+    """
+    Gets the record of the innermost block being measured.
+
+    Returns:
+        record (dict): The record, or a throwaway dictionary if nothing is being measured.
+    """
+    return _stack[-1] if _stack else {}
+
+
+def count(rows=None, cells=None):
+    """
+    Adds to the rows processed and cells written by the innermost block being measured.
+
+    Args:
+        rows (int): The number of rows processed.
+        cells (int): The number of cells written.
+
+    Returns:
+        None
+    """
+    record = current()
+    if rows is not None:
+        record['rows'] = record.get('rows', 0) + rows
+    if cells is not None:
+        record['cells'] = record.get('cells', 0) + cells
+
+
+def record_error(error):
+    """
+    Marks the innermost block being measured as failed, for errors that are caught and printed rather than raised.
+
+    Args:
+        error (Exception): The error.
+
+    Returns:
+        None
+    """
+    record = current()
+    record['status'] = 'error'
+    record['error'] = f"{type(error).__name__}: {error}"
+
+
+@contextmanager
+def measure(name, **fields):
+    """
+    Measures a block of code and emits its record when it ends.
+
+    The record holds the block's 'name', any extra fields given, its 'wall_s' and 'cpu_s', the process'
+    'peak_rss_mb', the 'rows' and 'cells' counted with count, its 'status' ('ok' or 'error') and 'error',
+    and the name of the enclosing block as 'parent'. Errors raised out of the block are recorded and re-raised.
+
+    Args:
+        name (str): The name of the block, e.g. the function or stage.
+        **fields: Extra fields for the record, e.g. the portfolio or file.
+
+    Returns:
+        record (dict): The block's record, yielded so the block can add to it.
+    """
+    record = {'name': name, **fields, 'status': 'ok', 'error': None,
+              'parent': _stack[-1]['name'] if _stack else None}
+    profiler = None
+    if _profile == 'cprofile' and not _stack:
+        profiler = cProfile.Profile()
+    if _profile == 'tracemalloc' and tracemalloc.is_tracing():
+        if _stack:
+            _stack[-1]['_traced_peak'] = max(_stack[-1].get('_traced_peak', 0), tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        record['_traced_peak'] = 0
+
+    _stack.append(record)
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield record
+    except BaseException as e:
+        record['status'] = 'error'
+        record['error'] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        record['wall_s'] = round(time.perf_counter() - start_wall, 6)
+        record['cpu_s'] = round(time.process_time() - start_cpu, 6)
+        record['peak_rss_mb'] = peak_rss_mb()
+        _stack.pop()
+
+        if '_traced_peak' in record:
+            peak = max(record.pop('_traced_peak'), tracemalloc.get_traced_memory()[1])
+            record['peak_traced_mb'] = round(peak / 2 ** 20, 3)
+            if _stack:
+                _stack[-1]['_traced_peak'] = max(_stack[-1].get('_traced_peak', 0), peak)
+
+        if profiler is not None and _path is not None:
+            record['profile'] = f"{_path}.{name}.{os.getpid()}.prof"
+            profiler.dump_stats(record['profile'])
+
+        record['pid'] = os.getpid()
+        record['ts'] = datetime.now().isoformat(timespec='seconds')
+        emit(record)
+
+
+def instrument(name=None):
+    """
+    Decorates a function so every call is measured (see measure). If the function returns a DataFrame
+    and the call didn't count its rows itself, the returned rows are counted.
+
+    Args:
+        name (str): The name of the block. Defaults to the function's name.
+
+    Returns:
+        decorator (function): The decorator.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with measure(name or function.__name__) as record:
+                result = function(*args, **kwargs)
+                if 'rows' not in record and hasattr(result, 'shape') and hasattr(result, 'columns'):
+                    record['rows'] = result.shape[0]
+                return result
+        return wrapper
+    return decorator
@@ -0,0 +1,232 @@
+"""
+SQLite store of the restricted list for generate-excel, keyed on each security's ISIN, SEDOL or Symbol.
+
+The store keeps every security that has been on the list with the day it was added ('start_date') and the
+day it was dropped ('end_date', empty while it is still on the list). A daily run hands today's full list
+to sync, which compares a hash of each row against the stored ones and only writes the securities that were
+added, dropped or changed, logging every write in the 'changes' table. The add, drop and change lists of a
+day then come straight from the store (see changes_on) instead of re-reading and diffing yesterday's list.
+"""
+
+# For DataFrames
+import pandas as pd
+
+# For the store
+import json
+import sqlite3
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS securities (
+    key TEXT PRIMARY KEY,
+    symbol TEXT,
+    isin TEXT,
+    sedol TEXT,
+    row_hash TEXT NOT NULL,
+    data TEXT NOT NULL,
+    start_date TEXT NOT NULL,
+    end_date TEXT
+);
+CREATE INDEX IF NOT EXISTS securities_isin ON securities (isin);
+CREATE INDEX IF NOT EXISTS securities_sedol ON securities (sedol);
+CREATE INDEX IF NOT EXISTS securities_symbol ON securities (symbol);
+CREATE INDEX IF NOT EXISTS securities_start ON securities (start_date);
+CREATE INDEX IF NOT EXISTS securities_end ON securities (end_date);
+
+CREATE TABLE IF NOT EXISTS changes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_date TEXT NOT NULL,
+    key TEXT NOT NULL,
+    action TEXT NOT NULL,
+    attribute TEXT,
+    before TEXT,
+    after TEXT
+);
+CREATE INDEX IF NOT EXISTS changes_run_date ON changes (run_date);
+"""
+
+# Columns that change every day without the security changing, so they aren't compared
+IGNORED_COLUMNS = ('StartDate',)
+
+# Format of the 'StartDate' given to dropped rows stored without one, as on the master list
+START_DATE_FORMAT = '%m/%d/%Y'
+
+
+def open_store(path):
+    """
+    Opens the store, creating its tables and indexes if they don't exist yet.
+
+    Args:
+        path (str): The path to the SQLite file.
+
+    Returns:
+        conn (sqlite3.Connection): The connection to the store.
+    """
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def is_empty(conn):
+    """
+    Checks whether the store has ever been synced.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the store.
+
+    Returns:
+        empty (bool): Whether the store has no securities.
+    """
+    return conn.execute('SELECT 1 FROM securities LIMIT 1').fetchone() is None
+
+
+def row_values(frame, ignore=IGNORED_COLUMNS):
+    """
+    Gets the values of a list's rows as strings, the form in which they are hashed and compared.
+
+    Args:
+        frame (pandas.DataFrame): The list.
+        ignore (tuple of str): The columns that aren't compared.
+
+    Returns:
+        values (pandas.DataFrame): The compared columns as strings, with '' for empty values.
+    """
+    values = frame[[c for c in frame.columns if c not in ignore]]
+    values = values.apply(lambda column: column.astype('Int64') if pd.api.types.is_float_dtype(column)
+                          and (column.dropna() % 1 == 0).all() else column)
+    return values.astype('string').fillna('')
+
+
+def sync(conn, frame, keys, run_date):
+    """
+    Brings the store in line with a day's full list, writing only the securities that changed.
+
+    Securities whose key is new (or was dropped before) are added with run_date as their start date, stored
+    securities missing from the list get run_date as their end date, and securities whose row hash differs
+    have their row replaced with one 'change' entry per changed attribute. Rows without a key can't be
+    tracked and are left out, and only the first row of a repeated key is kept. Syncing the same list again
+    writes nothing.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the store.
+        frame (pandas.DataFrame): The day's full list.
+        keys (pandas.Series): Each row's key, aligned with frame, e.g. 'ISIN:...' (see diff_key in generate-excel).
+        run_date (date or str): The day of the list.
+
+    Returns:
+        counts (dict): The number of securities 'added', 'dropped' and 'changed', and of rows 'skipped' for having no key.
+    """
+    run_date = pd.Timestamp(run_date).date().isoformat()
+    keep = keys.notna() & ~keys.duplicated()
+    skipped = int(keys.isna().sum())
+    frame, keys = frame[keep.to_numpy(dtype=bool)], keys[keep].astype(str)
+
+    values = row_values(frame).set_index(keys.to_numpy())
+    records = frame.set_index(keys.to_numpy())
+    hashes = pd.util.hash_pandas_object(values, index=False).astype(str)
+    stored = dict(conn.execute('SELECT key, row_hash FROM securities WHERE end_date IS NULL'))
+
+    added = [key for key in hashes.index if key not in stored]
+    dropped = [key for key in stored if key not in hashes.index]
+    changed = [key for key in hashes.index if key in stored and stored[key] != hashes[key]]
+
+    # Rows are serialized together, which matters when a whole list is added on the first sync
+    data = dict(zip(added, json.loads(records.loc[added].to_json(orient='records', date_format='iso'))))
+    ids = dict(zip(added, identifiers(values.loc[added])))
+    ended = dict(conn.execute('SELECT key, end_date FROM securities WHERE end_date IS NOT NULL'))
+
+    with conn:
+        # Dropped and put back on the same day, so it never left the list
+        conn.executemany('UPDATE securities SET end_date = NULL, row_hash = ?, data = ? WHERE key = ?',
+                         [(hashes[key], json.dumps(data[key]), key) for key in added if ended.get(key) == run_date])
+        conn.executemany('INSERT INTO securities (key, symbol, isin, sedol, row_hash, data, start_date, end_date) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?, NULL) ON CONFLICT (key) DO UPDATE SET '
+                         'symbol = excluded.symbol, isin = excluded.isin, sedol = excluded.sedol, '
+                         'row_hash = excluded.row_hash, data = excluded.data, start_date = excluded.start_date, '
+                         'end_date = NULL',
+                         [(key, *ids[key], hashes[key], json.dumps(data[key]), run_date)
+                          for key in added if ended.get(key) != run_date])
+        conn.executemany('INSERT INTO changes (run_date, key, action, after) VALUES (?, ?, ?, ?)',
+                         [(run_date, key, 'add', json.dumps(data[key])) for key in added])
+
+        for key in dropped:
+            conn.execute('UPDATE securities SET end_date = ? WHERE key = ?', (run_date, key))
+            conn.execute('INSERT INTO changes (run_date, key, action) VALUES (?, ?, ?)', (run_date, key, 'drop'))
+
+        for key in changed:
+            before = json.loads(conn.execute('SELECT data FROM securities WHERE key = ?', (key,)).fetchone()[0])
+            row = records.loc[key].to_json(date_format='iso')
+            after = json.loads(row)
+            current = values.loc[key]
+            conn.execute('UPDATE securities SET symbol = ?, isin = ?, sedol = ?, row_hash = ?, data = ? WHERE key = ?',
+                         (*identifiers(current.to_frame().T)[0], hashes[key], row, key))
+            for attribute in current.index:
+                if text(before.get(attribute)) != text(after.get(attribute)):
+                    conn.execute('INSERT INTO changes (run_date, key, action, attribute, before, after) '
+                                 'VALUES (?, ?, ?, ?, ?, ?)',
+                                 (run_date, key, 'change', attribute, before.get(attribute), after.get(attribute)))
+
+    return {'added': len(added), 'dropped': len(dropped), 'changed': len(changed), 'skipped': skipped}
+
+
+def identifiers(values):
+    """
+    Gets the indexed identifiers of rows.
+
+    Args:
+        values (pandas.DataFrame): The rows' values, see row_values.
+
+    Returns:
+        identifiers (list of tuple): Each row's Symbol, ISIN and SEDOL, None where it has none.
+    """
+    columns = values.reindex(columns=['Symbol', 'ISIN', 'SEDOL']).astype(object)
+    return list(columns.where(columns.notna() & (columns != ''), None).itertuples(index=False, name=None))
+
+
+def text(value):
+    """
+    Gets a stored value as a string for comparing, with '' for an empty value.
+
+    Args:
+        value: The value, as read back from a stored row.
+
+    Returns:
+        text (str): The value as a string.
+    """
+    return '' if value is None else str(value)
+
+
+def changes_on(conn, run_date):
+    """
+    Gets a day's net changes to the list from the store.
+
+    The store can be synced more than once a day, so an attribute changed by several syncs is reported once,
+    from its value before the first to its value after the last, and not at all if it ended up unchanged.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the store.
+        run_date (date or str): The day.
+
+    Returns:
+        add_df (pandas.DataFrame): The rows of the securities added that day and still on the list.
+        drop_df (pandas.DataFrame): The last stored rows of the securities dropped that day, with the day they
+        were added as their 'StartDate' if they were stored without one.
+        changed_df (pandas.DataFrame): The 'Key', 'Attribute', 'Before' and 'After' of each attribute changed that day.
+    """
+    run_date = pd.Timestamp(run_date).date().isoformat()
+    added = conn.execute('SELECT data FROM securities WHERE start_date = ? AND end_date IS NULL', (run_date,))
+    dropped = conn.execute('SELECT data, start_date FROM securities WHERE end_date = ? AND start_date != ?',
+                           (run_date, run_date))
+    add_df = pd.DataFrame([json.loads(data) for data, in added])
+    drop_df = pd.DataFrame([{'StartDate': pd.Timestamp(start_date).strftime(START_DATE_FORMAT), **json.loads(data)}
+                            for data, start_date in dropped])
+
+    changed_df = pd.read_sql_query('SELECT key AS "Key", attribute AS "Attribute", before AS "Before", after AS "After" '
+                                   'FROM changes WHERE run_date = ? AND action = ? ORDER BY id',
+                                   conn, params=(run_date, 'change'))
+    first = changed_df.drop_duplicates(['Key', 'Attribute'], keep='first')[['Key', 'Attribute', 'Before']]
+    last = changed_df.drop_duplicates(['Key', 'Attribute'], keep='last')[['Key', 'Attribute', 'After']]
+    changed_df = first.merge(last, on=['Key', 'Attribute'])
+    compared = changed_df[['Before', 'After']].astype('string').fillna('')
+    changed_df = changed_df[compared['Before'] != compared['After']].reset_index(drop=True)
+    return add_df, drop_df, changed_df
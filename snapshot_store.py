@@ -0,0 +1,235 @@
+"""
+Append-only store of the frames each evest-to-perf-sheet run extracts, partitioned by date and strategy.
+
+Every snapshot is written as its own file under <root>/<kind>/date=<YYYY-MM-DD>/strategy=<strategy>/, so
+a multi-period report reads a few small partitions instead of re-parsing the month-end workbooks. Nothing
+is ever overwritten: saving the same date and strategy again adds a newer part, and reads use the newest
+one. Parts are Parquet files when pyarrow or fastparquet is installed, and pickles otherwise.
+"""
+
+# For DataFrames
+import pandas as pd
+
+# For the partition layout
+import os
+import re
+from datetime import date, datetime
+from urllib.parse import quote, unquote
+
+# For finding a Parquet engine without importing it
+import importlib.util
+
+# Parquet needs pyarrow or fastparquet, pickles are used without them. They're only looked up here, pandas
+# imports them when a part is first written or read, so importing this module stays fast
+if importlib.util.find_spec('pyarrow') is not None or importlib.util.find_spec('fastparquet') is not None:
+    PART_FORMAT = 'parquet'
+else:
+    PART_FORMAT = 'pkl'
+
+
+# Name of the partition directories, the date and strategy are filled in
+PARTITION = 'date={date}/strategy={strategy}'
+
+# Name of the part files, the time they were written makes them unique and sortable
+PART_NAME = re.compile(r'part-(\d{8}T\d{6}\d{6})-(\d+)\.(parquet|pkl)$')
+
+
+def partition_dir(root, kind, snapshot_date, strategy):
+    """
+    Gets the directory of a partition.
+
+    Args:
+        root (str): The root directory of the store.
+        kind (str): The kind of frame, e.g. 'holdings'.
+        snapshot_date (date or str): The date of the snapshot.
+        strategy (str): The strategy, quoted so any name is a valid directory name.
+
+    Returns:
+        path (str): The partition's directory.
+    """
+    day = pd.Timestamp(snapshot_date).date().isoformat()
+    return os.path.join(root, kind, PARTITION.format(date=day, strategy=quote(strategy, safe='')))
+
+
+def save_snapshot(root, kind, frame, snapshot_date, strategy):
+    """
+    Adds a frame to the store as a new part of its date and strategy's partition.
+
+    The part is written to a temporary file and renamed, so readers never see a partial part.
+
+    Args:
+        root (str): The root directory of the store.
+        kind (str): The kind of frame, e.g. 'holdings', 'performance' or 'allocations'.
+        frame (pandas.DataFrame): The frame to save.
+        snapshot_date (date or str): The date the frame is for, e.g. the end of the reported month.
+        strategy (str): The strategy or portfolio the frame is for.
+
+    Returns:
+        path (str): The path of the new part.
+    """
+    directory = partition_dir(root, kind, snapshot_date, strategy)
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+    path = os.path.join(directory, f'part-{stamp}-{os.getpid()}.{PART_FORMAT}')
+
+    frame = frame.reset_index(drop=isinstance(frame.index, pd.RangeIndex))  # Keeps a meaningful index, e.g. the strategies
+    frame.columns = [str(column) for column in frame.columns]
+    if PART_FORMAT == 'parquet':
+        frame.to_parquet(path + '.tmp', index=False)
+    else:
+        frame.to_pickle(path + '.tmp')
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def list_snapshots(root, kind, strategy=None, start=None, end=None):
+    """
+    Lists the snapshots in the store, using only the directory names.
+
+    Args:
+        root (str): The root directory of the store.
+        kind (str): The kind of frame.
+        strategy (str): Only list this strategy's snapshots. Defaults to every strategy.
+        start (date or str): Only list snapshots on or after this date.
+        end (date or str): Only list snapshots on or before this date.
+
+    Returns:
+        snapshots (pandas.DataFrame): The 'date', 'strategy', 'path' of the newest part and number of 'parts'
+        of each snapshot, sorted by date and strategy.
+    """
+    rows = []
+    base = os.path.join(root, kind)
+    start = pd.Timestamp(start).date() if start is not None else None
+    end = pd.Timestamp(end).date() if end is not None else None
+    for date_dir in os.listdir(base) if os.path.isdir(base) else []:
+        if not date_dir.startswith('date='):
+            continue
+        day = date.fromisoformat(date_dir[len('date='):])
+        if (start is not None and day < start) or (end is not None and day > end):
+            continue
+        for strategy_dir in os.listdir(os.path.join(base, date_dir)):
+            if not strategy_dir.startswith('strategy='):
+                continue
+            name = unquote(strategy_dir[len('strategy='):])
+            if strategy is not None and name != strategy:
+                continue
+            directory = os.path.join(base, date_dir, strategy_dir)
+            parts = sorted(part for part in os.listdir(directory) if PART_NAME.match(part))
+            if parts:
+                rows.append({'date': day, 'strategy': name, 'path': os.path.join(directory, parts[-1]),
+                             'parts': len(parts)})
+
+    snapshots = pd.DataFrame(rows, columns=['date', 'strategy', 'path', 'parts'])
+    return snapshots.sort_values(['date', 'strategy'], ignore_index=True)
+
+
+def read_part(path, columns=None):
+    """
+    Reads one part of the store.
+
+    Args:
+        path (str): The path of the part.
+        columns (list of str): Only read these columns. Parquet parts skip the others entirely.
+
+    Returns:
+        frame (pandas.DataFrame): The part's frame.
+    """
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path, columns=columns)
+    frame = pd.read_pickle(path)
+    return frame[columns] if columns is not None else frame
+
+
+def load_snapshot(root, kind, snapshot_date, strategy, columns=None):
+    """
+    Reads the newest part of one snapshot.
+
+    Args:
+        root (str): The root directory of the store.
+        kind (str): The kind of frame.
+        snapshot_date (date or str): The date of the snapshot.
+        strategy (str): The strategy of the snapshot.
+        columns (list of str): Only read these columns.
+
+    Returns:
+        frame (pandas.DataFrame): The snapshot, or None if the store has none for that date and strategy.
+    """
+    snapshots = list_snapshots(root, kind, strategy, start=snapshot_date, end=snapshot_date)
+    if snapshots.empty:
+        return None
+    return read_part(snapshots['path'].iloc[-1], columns)
+
+
+def load_series(root, kind, strategy=None, months=None, years=None, end=None, columns=None):
+    """
+    Reads every snapshot over a number of months or years into one frame.
+
+    Args:
+        root (str): The root directory of the store.
+        kind (str): The kind of frame.
+        strategy (str): Only read this strategy's snapshots. Defaults to every strategy.
+        months (int): How many months back from end to read.
+        years (int): How many years back from end to read. Ignored if months is given, and everything is read
+        if neither is.
+        end (date or str): The last date to read. Defaults to the newest snapshot.
+        columns (list of str): Only read these columns.
+
+    Returns:
+        series (pandas.DataFrame): The snapshots' rows with their 'Snapshot Date' and 'Strategy' as the first
+        columns, oldest first.
+    """
+    snapshots = list_snapshots(root, kind, strategy, end=end)
+    if not snapshots.empty and (months is not None or years is not None):
+        last = pd.Timestamp(end if end is not None else snapshots['date'].iloc[-1])
+        start = last - pd.DateOffset(months=months) if months is not None else last - pd.DateOffset(years=years)
+        start = start + pd.Timedelta(days=1)  # N periods back, not N periods and a day
+        snapshots = snapshots[snapshots['date'] >= start.date()]
+
+    frames = []
+    for snapshot in snapshots.itertuples(index=False):
+        frame = read_part(snapshot.path, columns)
+        frame.insert(0, 'Strategy', snapshot.strategy)
+        frame.insert(0, 'Snapshot Date', pd.Timestamp(snapshot.date))
+        frames.append(frame)
+
+    if not frames:
+        return pd.DataFrame(columns=['Snapshot Date', 'Strategy'] + list(columns or []))
+    return pd.concat(frames, ignore_index=True)
+
+
+def compare_snapshots(root, kind, before, after, strategy, key, columns=None):
+    """
+    Compares two snapshots of a strategy row by row.
+
+    Args:
+        root (str): The root directory of the store.
+        kind (str): The kind of frame.
+        before (date or str): The date of the earlier snapshot.
+        after (date or str): The date of the later snapshot.
+        strategy (str): The strategy of the snapshots.
+        key (str or list of str): The columns identifying a row in both snapshots, e.g. 'Identifier'.
+        columns (list of str): The columns to compare. Defaults to every numeric column other than the key.
+
+    Returns:
+        comparison (pandas.DataFrame): One row per key in either snapshot, with each compared column's
+        '<column> (before)', '<column> (after)' and, for numbers, '<column> (change)', and a 'Status' of
+        'added', 'dropped' or 'kept'.
+    """
+    keys = [key] if isinstance(key, str) else list(key)
+    old = load_snapshot(root, kind, before, strategy)
+    new = load_snapshot(root, kind, after, strategy)
+    for day, frame in ((before, old), (after, new)):
+        if frame is None:
+            raise FileNotFoundError(f"No {kind} snapshot of {strategy} for {day}")
+    if columns is None:
+        columns = [c for c in new.columns if c not in keys and pd.api.types.is_numeric_dtype(new[c])]
+
+    comparison = old[keys + columns].merge(new[keys + columns], on=keys, how='outer',
+                                           suffixes=(' (before)', ' (after)'), indicator=True)
+    for column in columns:
+        if pd.api.types.is_numeric_dtype(new[column]):
+            comparison[f'{column} (change)'] = (comparison[f'{column} (after)'].fillna(0)
+                                                - comparison[f'{column} (before)'].fillna(0))
+    comparison['Status'] = comparison.pop('_merge').map({'left_only': 'dropped', 'right_only': 'added',
+                                                         'both': 'kept'}).astype(str)
+    return comparison
@@ -0,0 +1,84 @@
+"""
+Checks that the sheets written straight into the saved files read back in read-only mode, which sizes a
+sheet from its <dimension> element rather than its rows.
+"""
+
+import pandas as pd
+import pytest
+from openpyxl import load_workbook
+
+import cli
+import metrics
+
+
+@pytest.fixture
+def perf(tmp_path, monkeypatch):
+    script = cli.load_script('perf_sheet')
+    monkeypatch.setattr(script, 'data_loc', str(tmp_path) + '/')
+    metrics.configure(None)
+    return script
+
+
+def holdings(n):
+    return pd.DataFrame({
+        'Security': [f"Security {i}" for i in range(n)],
+        'Weight': [i / n for i in range(n)],
+        'Date': pd.Timestamp('2026-09-30'),
+    })
+
+
+def test_streamed_holdings_read_only(perf, tmp_path, monkeypatch):
+    monkeypatch.setattr(perf, 'stream_holdings', True)
+    df = holdings(250)
+
+    session = perf.WorkbookSession('out.xlsx')
+    perf.create_holds_excel(df, session)
+    assert session.save()
+
+    sheet = load_workbook(tmp_path / 'out.xlsx', read_only=True)['Holdings']
+    rows = list(sheet.values)
+    assert sheet.max_row == len(df) + 1
+    assert sheet.max_column == len(df.columns)
+    assert len(rows) == len(df) + 1
+    assert rows[1][:2] == ('Security 0', 0)
+    assert rows[-1][:2] == ('Security 249', 249 / 250)
+
+
+def test_rerun_replaces_streamed_holdings(perf, tmp_path, monkeypatch):
+    monkeypatch.setattr(perf, 'stream_holdings', True)
+    session = perf.WorkbookSession('out.xlsx')
+    perf.create_holds_excel(holdings(250), session)
+    pd.DataFrame({'Return': [0.1, 0.2]}).to_excel(session.writer, sheet_name='Performance')
+    assert session.save()
+
+    # The old Holdings sheet is emptied before the workbook is parsed, the other sheets are kept
+    session = perf.WorkbookSession('out.xlsx', ['Holdings'])
+    assert session.book.sheetnames == ['Holdings', 'Performance']
+    assert session.book['Holdings'].max_row == 1
+    perf.create_holds_excel(holdings(40), session)
+    assert session.save()
+
+    book = load_workbook(tmp_path / 'out.xlsx', read_only=True)
+    assert book.sheetnames == ['Holdings', 'Performance']
+    assert book['Holdings'].max_row == 41
+    assert list(book['Performance'].values)[2] == (1, 0.2)
+
+
+def test_master_list_read_only(tmp_path):
+    restricted = cli.load_script('restricted_list')
+    metrics.configure(None)
+    constants = restricted.master_list_constants()
+    columns = restricted.master_list_columns(constants)
+    df = pd.DataFrame([[f"{column} {i}" for column in columns] for i in range(250)], columns=columns)
+
+    restricted.write_master_list_xlsx(df, str(tmp_path / 'master.xlsx'), constants)
+
+    sheet = load_workbook(tmp_path / 'master.xlsx', read_only=True)['Sheet1']
+    rows = list(sheet.values)
+    assert sheet.max_row == len(df) + 1
+    assert sheet.max_column == len(restricted.MASTER_LIST_COLUMNS)
+    assert len(rows) == len(df) + 1
+    assert rows[0] == tuple(restricted.MASTER_LIST_COLUMNS)
+
+    header = load_workbook(tmp_path / 'master.xlsx')['Sheet1']['A1']
+    assert header.font.b and header.border.left.style == 'thin' and header.alignment.horizontal == 'center'
@@ -0,0 +1,49 @@
+"""
+Streaming of rows into .xlsx files, shared by evest-to-perf-sheet and generate-excel.
+
+openpyxl keeps every cell of a workbook in memory as an object, which is what makes large sheets slow and
+memory hungry to write. Instead, the workbook is saved by openpyxl with only what's above the rows (e.g. a
+formatted header) and its styles, and write_streamed_sheets then copies the saved file with the rows
+written straight into the sheets' XML, generated as they're needed so memory stays flat however many
+rows there are.
+"""
+
+# For rewriting the parts of the saved file
+import io
+import re
+import shutil
+import zipfile
+
+
+def write_streamed_sheets(source, path, sheets):
+    """
+    Writes a copy of an .xlsx file with rows added to the end of some of its sheets.
+
+    The rows are written as they are generated, and each sheet's <dimension> is set to its new size, since
+    readers in read-only mode size a sheet from it rather than from its rows.
+
+    Args:
+        source (str or file-like): The .xlsx file, as saved by openpyxl.
+        path (str): The path of the copy to write. It shouldn't be the source file.
+        sheets (dict): For the part of each sheet to add rows to (e.g. 'xl/worksheets/sheet1.xml', see
+        Worksheet.path), its new dimension (e.g. 'A1:J100') and an iterable of the XML of the rows to add.
+
+    Returns:
+        None
+    """
+    with zipfile.ZipFile(source) as archive, zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as target:
+        for item in archive.infolist():
+            if item.filename not in sheets:
+                with archive.open(item) as src, target.open(item, 'w') as dst:
+                    shutil.copyfileobj(src, dst)
+                continue
+
+            dimension, rows = sheets[item.filename]
+            sheet_xml = archive.read(item).decode('utf-8').replace('<sheetData/>', '<sheetData></sheetData>')
+            head, tail = sheet_xml.split('</sheetData>')
+            head = re.sub(r'<dimension ref="[^"]*"\s*/>', f'<dimension ref="{dimension}"/>', head)
+            with target.open(item.filename, 'w', force_zip64=True) as dst, io.TextIOWrapper(dst, encoding='utf-8') as out:
+                out.write(head)
+                for row in rows:
+                    out.write(row)
+                out.write('</sheetData>' + tail)